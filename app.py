@@ -14,6 +14,7 @@ from data_definitions import (
     GeodesignhubDiagramGeoJSON,
     ShadowViewSuccessResponse,
     RoadsShadowOverlap,
+    RoadsShadowSeries,
     ToolboxDesignViewDetails,
     ToolboxDiagramViewDetails,
     FloodingViewSuccessResponse,
@@ -37,6 +38,18 @@ from download_helper import (
     RoadsDownloadFactory,
     kickoff_drawn_trees_shadow_job,
 )
+from shadow_precision import FULL_FIDELITY, full_fidelity_key
+from vector_tiles import VECTOR_TILE_LAYERS, get_vector_tile
+from geometry_store import layer_to_geojson
+from value_codec import (
+    decode_value,
+    gzip_payload,
+    gzip_bytes,
+    VALUE_COMPRESSION_MIN_BYTES,
+)
+from road_shade import load_road_shade_layer
+from job_results import get_session_notifications
+from baseline_shadows import find_baseline_shadow_key
 import arrow
 import uuid
 import geojson
@@ -102,29 +115,130 @@ def set_language(language=None):
     return redirect(request.referrer)
 
 
+def get_shadow_variant(shadow_key, fidelity=None):
+    """Returns the stored shadow, the full fidelity variant is returned if it was asked for and is still stored"""
+    if fidelity == FULL_FIDELITY:
+        s = redis.get(full_fidelity_key(shadow_key))
+        if s is not None:
+            return s
+    return redis.get(shadow_key)
+
+
+def accepts_gzip() -> bool:
+    return request.accept_encodings["gzip"] > 0
+
+
+def gzip_response(payload: bytes) -> Response:
+    response = Response(payload, status=200, mimetype=MIMETYPE)
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def json_response(body: str) -> Response:
+    """Returns a JSON or GeoJSON body, large bodies are gzip encoded if the client accepts it"""
+    if len(body) >= VALUE_COMPRESSION_MIN_BYTES and accepts_gzip():
+        return gzip_response(gzip_bytes(body.encode("utf-8")))
+    response = Response(body, status=200, mimetype=MIMETYPE)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def stored_json_response(raw: bytes) -> Response:
+    """Returns a stored JSON value, values stored gzip compressed are forwarded without decompressing them if the client accepts gzip"""
+    payload = gzip_payload(raw)
+    if payload is not None and accepts_gzip():
+        return gzip_response(payload)
+    return json_response(decode_value(raw).decode("utf-8"))
+
+
+@app.route("/session_notifications", methods=["GET"])
+def get_notifications_for_session():
+    """Returns the notifications already published for a session, a page replays the ones after the last it received when it subscribes"""
+    session_id = request.args.get("session_id", "0")
+    since = request.args.get("since", 0, type=int)
+    return Response(
+        json.dumps(get_session_notifications(session_id, since=max(since, 0))),
+        status=200,
+        mimetype=MIMETYPE,
+    )
+
+
 @app.route("/gdh_generated_shadow", methods=["GET"])
 def get_diagram_shadow():
     shadow_key = request.args.get("shadow_key", "0")
+    fidelity = request.args.get("fidelity", None)
 
     shadow_exists = redis.exists(shadow_key)
     if shadow_exists:
-        s = redis.get(shadow_key)
-        shadow = json.loads(s)
+        shadow_data_key = redis.get(shadow_key)
+        s = get_shadow_variant(shadow_data_key, fidelity)
+        shadow = layer_to_geojson(s)
+    else:
+        shadow = json.dumps({"type": "FeatureCollection", "features": []})
+    return json_response(shadow)
+
+
+@app.route("/gdh_generated_shadow_sweep", methods=["GET"])
+def get_diagram_shadow_sweep():
+    """Returns the computed times of a shadow sweep or, if a date_time is given, the shadow at that time"""
+    shadow_sweep_key = request.args.get("shadow_sweep_key", "0")
+    date_time = request.args.get("date_time", None)
+
+    if date_time is None:
+        sweep_date_times = sorted(
+            t.decode("utf-8") for t in redis.hkeys(shadow_sweep_key)
+        )
+        return Response(
+            json.dumps({"date_times": sweep_date_times}),
+            status=200,
+            mimetype=MIMETYPE,
+        )
+
+    s = redis.hget(shadow_sweep_key, date_time)
+    if s is None:
+        shadow = json.dumps({"type": "FeatureCollection", "features": []})
     else:
-        shadow = {"type": "FeatureCollection", "features": []}
-    return Response(shadow, status=200, mimetype=MIMETYPE)
+        shadow = layer_to_geojson(s)
+    return json_response(shadow)
+
+
+@app.route("/gdh_shadow_hours/<shadow_hours_key>.tif", methods=["GET"])
+def get_diagram_shadow_hours(shadow_hours_key):
+    """Serves the shadow hours Cloud-Optimized GeoTIFF, range requests are supported so the map only reads the tiles it needs"""
+    shadow_hours = redis.get(shadow_hours_key)
+    if shadow_hours is None:
+        return Response(status=404)
+    response = Response(shadow_hours, status=200, mimetype="image/tiff")
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=len(shadow_hours)
+    )
+
+
+@app.route("/tiles/<layer>/<session_key>/<int:z>/<int:x>/<int:y>.pbf", methods=["GET"])
+def get_layer_vector_tile(layer, session_key, z, x, y):
+    """Serves a Mapbox Vector Tile of a stored session layer so the map only loads the visible part of large layers"""
+    if layer not in VECTOR_TILE_LAYERS:
+        return Response(status=404)
+    tile = get_vector_tile(layer, session_key, z, x, y)
+    if tile is None:
+        return Response(status=404)
+    if not tile:
+        return Response(status=204)
+    return Response(tile, status=200, mimetype="application/x-protobuf")
 
 
 @app.route("/existing_buildings_generated_shadow", methods=["GET"])
 def get_existing_buildings_shadow():
     shadow_key = request.args.get("shadow_key", "0")
+    fidelity = request.args.get("fidelity", None)
     shadow_exists = redis.exists(shadow_key)
     if shadow_exists:
-        s = redis.get(shadow_key)
-        shadow = json.loads(s)
+        s = get_shadow_variant(shadow_key, fidelity)
+        shadow = layer_to_geojson(s)
     else:
-        shadow = {"type": "FeatureCollection", "features": []}
-    return Response(json.dumps(shadow), status=200, mimetype=MIMETYPE)
+        shadow = json.dumps({"type": "FeatureCollection", "features": []})
+    return json_response(shadow)
 
 
 @app.route("/get_downloaded_roads", methods=["GET"])
@@ -134,12 +248,11 @@ def get_downloaded_roads():
     if roads_session_exists:
         roads_data_key = redis.get(roads_key)
         r_raw = redis.get(roads_data_key)
-        roads = json.loads(r_raw.decode("utf-8"))
+        rds = layer_to_geojson(r_raw)
     else:
-        roads = {"type": "FeatureCollection", "features": []}
+        rds = json.dumps({"type": "FeatureCollection", "features": []})
 
-    rds = json.dumps(roads)
-    return Response(rds, status=200, mimetype=MIMETYPE)
+    return json_response(rds)
 
 
 @app.route("/get_downloaded_trees", methods=["GET"])
@@ -149,13 +262,11 @@ def get_downloaded_trees():
     if trees_session_exists:
         trees_data_key = redis.get(trees_key)
         r_raw = redis.get(trees_data_key)
-        trees = json.loads(r_raw.decode("utf-8"))
+        trs = layer_to_geojson(r_raw)
     else:
-        trees = {"type": "FeatureCollection", "features": []}
+        trs = json.dumps({"type": "FeatureCollection", "features": []})
 
-    trs = json.dumps(trees)
-
-    return Response(trs, status=200, mimetype=MIMETYPE)
+    return json_response(trs)
 
 
 @app.route("/existing_buildings_shadow_roads_stats", methods=["GET"])
@@ -164,15 +275,11 @@ def get_existing_buildings_shadow_roads_stats():
     roads_shadow_stats_exists = redis.exists(roads_shadow_stats_key)
 
     if roads_shadow_stats_exists:
-        s = redis.get(roads_shadow_stats_key)
-        shadow_stats = json.loads(s)
-    else:
-        default_shadow = RoadsShadowOverlap(
-            total_roads_kms=0.0, shadowed_kms=0.0, job_id="0000", total_shadow_area=0.0
-        )
-        shadow_stats = asdict(default_shadow)
-
-    return Response(json.dumps(shadow_stats), status=200, mimetype=MIMETYPE)
+        return stored_json_response(redis.get(roads_shadow_stats_key))
+    default_shadow = RoadsShadowOverlap(
+        total_roads_kms=0.0, shadowed_kms=0.0, job_id="0000", total_shadow_area=0.0
+    )
+    return json_response(json.dumps(asdict(default_shadow)))
 
 
 @app.route("/get_shadow_roads_stats", methods=["GET"])
@@ -182,15 +289,37 @@ def generate_shadow_road_stats():
     roads_shadow_stats_exists = redis.exists(roads_shadow_stats_key)
 
     if roads_shadow_stats_exists:
-        s = redis.get(roads_shadow_stats_key)
-        shadow_stats = json.loads(s)
+        return stored_json_response(redis.get(roads_shadow_stats_key))
+    default_shadow = RoadsShadowOverlap(
+        total_roads_kms=0.0, shadowed_kms=0.0, job_id="0000", total_shadow_area=0.0
+    )
+    return json_response(json.dumps(asdict(default_shadow)))
+
+
+@app.route("/get_roads_shadow_series", methods=["GET"])
+def get_roads_shadow_series():
+    """Returns the shaded roads for every time of the day as a series for charting"""
+    roads_shadow_series_key = request.args.get("roads_shadow_series_key", "0")
+
+    s = redis.get(roads_shadow_series_key)
+    if s is not None:
+        return stored_json_response(s)
+    default_series = RoadsShadowSeries(
+        job_id="0000", total_roads_kms=0.0, date_times=[], shadowed_kms=[]
+    )
+    return json_response(json.dumps(asdict(default_series)))
+
+
+@app.route("/get_road_shade", methods=["GET"])
+def get_road_shade():
+    segment_shade_key = request.args.get("segment_shade_key", "0")
+    road_shade_raw = redis.get(segment_shade_key)
+    if road_shade_raw is not None:
+        rs = load_road_shade_layer(road_shade_raw).to_json()
     else:
-        default_shadow = RoadsShadowOverlap(
-            total_roads_kms=0.0, shadowed_kms=0.0, job_id="0000", total_shadow_area=0.0
-        )
-        shadow_stats = asdict(default_shadow)
+        rs = json.dumps({"type": "FeatureCollection", "features": []})
 
-    return Response(json.dumps(shadow_stats), status=200, mimetype=MIMETYPE)
+    return json_response(rs)
 
 
 @app.route("/design_flooding_analysis/", methods=["GET"])
@@ -371,8 +500,13 @@ def generate_design_shadow():
         shadow_date_time=shadow_date_time,
         bounds=project_data.bounds.bounds,
         project_id=projectid,
+        shadow_engine=request.args.get("shadow_engine", None),
+        fidelity=request.args.get("fidelity", None),
+    )
+    cached_shadow_key = shadow_computation_helper.compute_gdh_buildings_shadow()
+    baseline_shadow_key = find_baseline_shadow_key(
+        project_data.bounds.bounds, shadow_date_time
     )
-    shadow_computation_helper.compute_gdh_buildings_shadow()
 
     # Download Data
     maptiler_key = os.getenv("maptiler_key", "00000000000000")
@@ -389,6 +523,8 @@ def generate_design_shadow():
         shadow_date_time=shadow_date_time,
         trees_wms_url=trees_wms_url,
         view_details=design_view_details,
+        cached_shadow_key=cached_shadow_key if cached_shadow_key else "",
+        baseline_shadow_key=baseline_shadow_key if baseline_shadow_key else "",
     )
 
     return render_template("design_shadow.html", op=asdict(success_response))
@@ -397,17 +533,16 @@ def generate_design_shadow():
 @app.route("/get_drawn_trees_shadows", methods=["GET"])
 def get_drawn_trees_shadows():
     trees_key = request.args.get("drawn_trees_shadows_key", "0")
-    
+    fidelity = request.args.get("fidelity", None)
+
     trees_session_exists = redis.exists(trees_key)
     if trees_session_exists:
-        trees_data_raw = redis.get(trees_key)
-        trees = json.loads(trees_data_raw.decode("utf-8"))
+        trees_data_raw = get_shadow_variant(trees_key, fidelity)
+        trs = layer_to_geojson(trees_data_raw)
     else:
-        trees = {"type": "FeatureCollection", "features": []}
-
-    trs = json.dumps(trees)
+        trs = json.dumps({"type": "FeatureCollection", "features": []})
 
-    return Response(trs, status=200, mimetype=MIMETYPE)
+    return json_response(trs)
 
 
 @app.route("/generate_drawn_trees_shadow/", methods=["POST"])
@@ -418,7 +553,10 @@ def generate_drawn_trees_shadow():
     session_id = request.args.get("session_id")
 
     kickoff_drawn_trees_shadow_job(
-        unprocessed_drawn_trees=unprocessed_tree_geojson, session_id=session_id
+        unprocessed_drawn_trees=unprocessed_tree_geojson,
+        session_id=session_id,
+        shadow_engine=request.args.get("shadow_engine", None),
+        fidelity=request.args.get("fidelity", None),
     )
 
     return Response({}, status=200, mimetype=MIMETYPE)
@@ -496,8 +634,14 @@ def generate_diagram_shadow():
                 shadow_date_time=shadow_date_time,
                 bounds=project_data.bounds.bounds,
                 project_id=projectid,
+                shadow_engine=request.args.get("shadow_engine", None),
+                fidelity=request.args.get("fidelity", None),
+            )
+            cached_shadow_key = shadow_computation_helper.compute_gdh_buildings_shadow()
+            shadow_computation_helper.compute_gdh_buildings_shadow_sweep()
+            baseline_shadow_key = find_baseline_shadow_key(
+                project_data.bounds.bounds, shadow_date_time
             )
-            shadow_computation_helper.compute_gdh_buildings_shadow()
 
             success_response = ShadowViewSuccessResponse(
                 status=1,
@@ -510,6 +654,8 @@ def generate_diagram_shadow():
                 trees_wms_url=trees_wms_url,
                 view_details=diagram_view_details,
                 trees_feature_collection=trees_feature_collection,
+                cached_shadow_key=cached_shadow_key if cached_shadow_key else "",
+                baseline_shadow_key=baseline_shadow_key if baseline_shadow_key else "",
             )
 
             return render_template("diagram_shadow.html", op=asdict(success_response))
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import arrow
+from typing import Dict, List, Optional
+from conn import get_redis
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+BASELINE_SHADOW_TTL = int(os.getenv("BASELINE_SHADOW_TTL", 604800))
+BASELINE_DATE_TIME_FORMAT = "YYYY-MM-DDTHH:mm:ss"
+LEAP_YEAR = 2000
+# Six decimals is about ten centimetres, bounds that differ less describe the same project
+BOUNDS_PRECISION = 6
+
+
+def get_baseline_projects() -> Dict[str, str]:
+    """Returns the projects to precompute a baseline for as project id and bounds, set as JSON in BASELINE_PROJECTS"""
+    return json.loads(os.getenv("BASELINE_PROJECTS", "{}"))
+
+
+def get_baseline_date_times(year: Optional[int] = None) -> List[str]:
+    """Returns every configured reference date combined with every reference time for the year"""
+    year = year if year else arrow.now().year
+    dates = os.getenv("BASELINE_SHADOW_DATES", "08-06").split(",")
+    times = os.getenv("BASELINE_SHADOW_TIMES", "09:00,10:10,12:00,15:00,18:00").split(",")
+    # Dates are parsed in a leap year so 02-29 can be configured
+    return [
+        in_year(
+            arrow.get(
+                "{year}-{date}T{time}".format(
+                    year=LEAP_YEAR, date=d.strip(), time=t.strip()
+                )
+            ),
+            year,
+        ).format(BASELINE_DATE_TIME_FORMAT)
+        for d in dates
+        for t in times
+    ]
+
+
+def in_year(date_time: arrow.Arrow, year: int) -> arrow.Arrow:
+    """Moves the time to the same day of another year, 29 February becomes 28 February in years that are not leap years"""
+    try:
+        return date_time.replace(year=year)
+    except ValueError:
+        return date_time.replace(day=28).replace(year=year)
+
+
+def normalize_bounds(bounds: str) -> str:
+    """Formats the bounds the same way however they were written so every request of a project finds its baselines"""
+    return ",".join(
+        "{:.{p}f}".format(float(b), p=BOUNDS_PRECISION) for b in bounds.split(",")
+    )
+
+
+def _bounds_hash(bounds: str) -> str:
+    return hashlib.sha512(normalize_bounds(bounds).encode("utf-8")).hexdigest()[:15]
+
+
+def baseline_shadow_key(bounds: str, request_date_time: str) -> str:
+    """The baseline depends only on the bounds and the time, it is shared by every session of the project"""
+    return "baseline_shadow:" + _bounds_hash(bounds) + ":" + request_date_time
+
+
+def baseline_index_key(bounds: str) -> str:
+    return "baseline_shadows:" + _bounds_hash(bounds)
+
+
+def find_baseline_shadow_key(bounds: str, shadow_date_time: str) -> Optional[str]:
+    """Returns the key of the stored baseline closest to the requested time of year, None when none is close enough"""
+    index = r.hgetall(baseline_index_key(bounds))
+    if not index:
+        return None
+    requested = arrow.get(shadow_date_time)
+    max_offset = int(os.getenv("BASELINE_SHADOW_MAX_OFFSET_MINUTES", 30)) * 60
+    closest_key = None
+    closest_offset = None
+    for reference_date_time, key in index.items():
+        # The sun is in practically the same position on the same day of every year
+        reference = in_year(
+            arrow.get(reference_date_time.decode("utf-8")), requested.year
+        )
+        offset = abs((reference - requested).total_seconds())
+        if offset <= max_offset and (closest_offset is None or offset < closest_offset):
+            closest_key = key.decode("utf-8")
+            closest_offset = offset
+    if closest_key is None or not r.exists(closest_key):
+        return None
+    return closest_key
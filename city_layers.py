@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
+import numpy as np
+import shapely
+from typing import Callable, Iterator, List, Optional, Tuple
+from conn import get_redis
+from geometry_store import LayerWriter
+from layer_ingest import iter_feature_chunks, feature_geometries, INGEST_CHUNK_FEATURES
+from source_cache import SourceCache, SourceBody, source_cache
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+CITY_LAYER_DIR = os.getenv(
+    "CITY_LAYER_DIR", os.path.join(tempfile.gettempdir(), "gdh-city-layers")
+)
+
+_schema = """
+CREATE TABLE features (id INTEGER PRIMARY KEY, geometry BLOB NOT NULL, properties TEXT NOT NULL);
+CREATE VIRTUAL TABLE features_index USING rtree(id, min_x, max_x, min_y, max_y);
+CREATE TABLE source (validators TEXT);
+"""
+
+_extract_query = """
+SELECT features.geometry, features.properties FROM features_index
+JOIN features ON features.id = features_index.id
+WHERE features_index.max_x >= ? AND features_index.min_x <= ?
+AND features_index.max_y >= ? AND features_index.min_y <= ?
+ORDER BY features.id
+"""
+
+
+class CityLayerStore:
+    """Ingests every source layer once into a SQLite file with an R*Tree index so the layer of any bounds is extracted with an index query.
+
+    Stores are keyed by the source url, projects in the same city share them, they are ingested again only when the source changes.
+    """
+
+    def __init__(
+        self, directory: str = CITY_LAYER_DIR, cache: Optional[SourceCache] = None
+    ):
+        self.directory = directory
+        self.source_cache = cache if cache else source_cache
+
+    def store_path(self, url: str) -> str:
+        return os.path.join(
+            self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".sqlite"
+        )
+
+    def read_source_validators(self, path: str) -> Optional[dict]:
+        try:
+            with closing(
+                sqlite3.connect("file:" + path + "?mode=ro", uri=True)
+            ) as connection:
+                row = connection.execute("SELECT validators FROM source").fetchone()
+        except sqlite3.Error:
+            return None
+        return json.loads(row[0]) if row else None
+
+    def _ingest(self, source_body: SourceBody, path: str):
+        """Writes the layer to a new store next to the current one and replaces it once it is complete"""
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, ingest_path = tempfile.mkstemp(dir=self.directory, suffix=".partial")
+        os.close(descriptor)
+        count = 0
+        try:
+            with closing(sqlite3.connect(ingest_path)) as connection, connection:
+                connection.executescript(_schema)
+                for feature_chunk in iter_feature_chunks(source_body):
+                    geometries = feature_geometries(feature_chunk)
+                    is_present = ~shapely.is_missing(geometries)
+                    ids = np.arange(count, count + len(feature_chunk))[is_present]
+                    geometries = geometries[is_present]
+                    bounds = shapely.bounds(geometries)
+                    connection.executemany(
+                        "INSERT INTO features VALUES (?, ?, ?)",
+                        zip(
+                            ids.tolist(),
+                            shapely.to_wkb(geometries),
+                            [
+                                json.dumps(f.get("properties") or {}, default=str)
+                                for f, present in zip(feature_chunk, is_present)
+                                if present
+                            ],
+                        ),
+                    )
+                    connection.executemany(
+                        "INSERT INTO features_index VALUES (?, ?, ?, ?, ?)",
+                        zip(
+                            ids.tolist(),
+                            bounds[:, 0].tolist(),
+                            bounds[:, 2].tolist(),
+                            bounds[:, 1].tolist(),
+                            bounds[:, 3].tolist(),
+                        ),
+                    )
+                    count += len(feature_chunk)
+                connection.execute(
+                    "INSERT INTO source VALUES (?)",
+                    (json.dumps(source_body.validators),),
+                )
+            os.replace(ingest_path, path)
+        except BaseException:
+            os.unlink(ingest_path)
+            raise
+        logger.info("Ingested %s features into %s" % (str(count), path))
+
+    def refresh(self, url: str) -> Optional[str]:
+        """Revalidates the source of a store and ingests it if it changed, returns the path of the store or None if there is none"""
+        path = self.store_path(url)
+        with self.source_cache.open(url) as source_body:
+            if source_body is None:
+                if os.path.exists(path):
+                    logger.error("Source %s could not be downloaded, using the stored layer" % url)
+                    return path
+                return None
+            validators = source_body.validators
+            has_validators = validators.get("etag") or validators.get("last_modified")
+            if (
+                has_validators
+                and os.path.exists(path)
+                and self.read_source_validators(path) == validators
+            ):
+                return path
+            self._ingest(source_body, path)
+        return path
+
+    def extract(
+        self, path: str, bounds: str, chunk_features: int = INGEST_CHUNK_FEATURES
+    ) -> Iterator[Tuple[np.ndarray, List[dict]]]:
+        """Yields the geometries and properties of the features that intersect the bounds in chunks"""
+        xmin, ymin, xmax, ymax = [float(b) for b in bounds.split(",")]
+        bounds_box = shapely.box(xmin, ymin, xmax, ymax)
+        with closing(
+            sqlite3.connect("file:" + path + "?mode=ro", uri=True)
+        ) as connection:
+            cursor = connection.execute(_extract_query, (xmin, xmax, ymin, ymax))
+            while True:
+                rows = cursor.fetchmany(chunk_features)
+                if not rows:
+                    return
+                geometries = shapely.from_wkb([row[0] for row in rows])
+                # The index holds rounded boxes, only features that really intersect the bounds are kept
+                intersecting = shapely.intersects(geometries, bounds_box)
+                yield geometries[intersecting], [
+                    json.loads(row[1])
+                    for row, keep in zip(rows, intersecting)
+                    if keep
+                ]
+
+
+city_layer_store = CityLayerStore()
+
+
+def extract_city_layer(
+    url: str,
+    bounds: str,
+    storage_key: str,
+    ttl: int = 60000,
+    normalize_properties: Optional[Callable[[List[dict]], List[dict]]] = None,
+) -> bool:
+    """Stores the features of the city layer at the url that intersect the bounds, returns False if the layer could not be downloaded"""
+    path = city_layer_store.refresh(url)
+    if path is None:
+        return False
+    layer_writer = LayerWriter()
+    try:
+        for geometries, properties in city_layer_store.extract(path, bounds):
+            if normalize_properties:
+                properties = normalize_properties(properties)
+            layer_writer.add(geometries, properties)
+        layer_writer.write(r, storage_key, ttl)
+    finally:
+        layer_writer.close()
+    logger.info(
+        "Extracted %s features for %s from the city layer"
+        % (str(layer_writer.count), storage_key)
+    )
+    return True
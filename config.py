@@ -148,6 +148,34 @@ class wms_url_generator:
 
         return trees_wms_url
 
+    def get_trees_url(self):
+        """
+        This is the raw / GeoJSON url for the tree canopy
+        """
+        project_specific_url = "{project_id}_TREES_URL".format(
+            project_id=self.project_id
+        )
+        if environ.get(project_specific_url, None) is not None:
+            trees_url = environ.get(project_specific_url)
+        else:
+            trees_url = environ.get("TREES_URL", "0")
+
+        return trees_url
+
+    def get_buildings_url(self):
+        """
+        This is the raw / GeoJSON url for the existing buildings
+        """
+        project_specific_url = "{project_id}_BUILDINGS_URL".format(
+            project_id=self.project_id
+        )
+        if environ.get(project_specific_url, None) is not None:
+            buildings_url = environ.get(project_specific_url)
+        else:
+            buildings_url = environ.get("BUILDINGS_URL", "0")
+
+        return buildings_url
+
     def get_project_landuse_wms(self):
         """
         This is the raw / GeoJSON url for roads
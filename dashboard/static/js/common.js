@@ -67,7 +67,7 @@ function get_drawn_trees_shadows(drawn_trees_download_url) {
             spinner_cont.classList.add('d-none');                
             let shadows_to_render = shadow_data;
             
-            map.getSource('tree_shadows').setData(JSON.parse(shadows_to_render));
+            map.getSource('tree_shadows').setData(shadows_to_render);
             // map.getSource('existing_building_shadows').setData(shadows_to_render);
         }).catch((error) => {
             console.log(error);
@@ -112,6 +112,87 @@ function get_downloaded_roads(roads_url) {
             
         });
     }
+function set_vector_tile_source(source_id, tile_layer, session_key) {
+    // Replaces a source with vector tiles of the stored layer so only the visible tiles are downloaded,
+    // the layers drawn from the source are added back at the same position
+    let tiles_url = window.location.origin + '/tiles/' + tile_layer + '/' + encodeURIComponent(session_key) + '/{z}/{x}/{y}.pbf';
+    let style_layers = map.getStyle().layers;
+    let source_layers = [];
+    style_layers.forEach((layer, index) => {
+        if (layer.source === source_id) {
+            let next_layer = style_layers.slice(index + 1).find((l) => l.source !== source_id);
+            source_layers.push([layer, next_layer ? next_layer.id : undefined]);
+        }
+    });
+    source_layers.forEach(([layer]) => map.removeLayer(layer.id));
+    map.removeSource(source_id);
+    map.addSource(source_id, {
+        'type': 'vector',
+        'tiles': [tiles_url],
+        'maxzoom': 16
+    });
+    source_layers.forEach(([layer, before_id]) => {
+        layer['source-layer'] = tile_layer;
+        map.addLayer(layer, before_id);
+    });
+}
+
+function set_road_shade_source(segment_shade_key) {
+    // The roads are drawn from their shade so the streets that need trees stand out
+    set_vector_tile_source('bike_pedestrian_roads', 'road_shade', segment_shade_key);
+    map.setPaintProperty('bike_pedestrian_roads', 'line-color', [
+        'interpolate', ['linear'], ['get', 'shaded_fraction'],
+        0, '#d7301f',
+        0.5, '#fee08b',
+        1, '#1a9850'
+    ]);
+}
+
+function replay_session_notifications(source, session_id, notification_types) {
+    // Jobs that finished before the page subscribed, or while the stream reconnected, are notified again from the notifications recorded for the session.
+    // Every notification carries its position in the session so the ones the page already received are not dispatched again.
+    let received_notification_ids = new Set();
+    let next_notification_id = 0;
+    function receive_notification(data) {
+        if (data['session_id'] !== session_id || data['notification_id'] === undefined) {
+            return;
+        }
+        received_notification_ids.add(data['notification_id']);
+        next_notification_id = Math.max(next_notification_id, data['notification_id'] + 1);
+    }
+    notification_types.forEach((notification_type) => {
+        source.addEventListener(notification_type, function (event) {
+            receive_notification(JSON.parse(event.data));
+        }, false);
+    });
+
+    function replay() {
+        let notifications_url = window.location.origin + '/session_notifications?session_id=' + session_id + '&since=' + next_notification_id;
+        fetch(notifications_url)
+            .then((response) => {
+                return response.json();
+            })
+            .then((notifications) => {
+                notifications.forEach((notification) => {
+                    if (!received_notification_ids.has(notification['data']['notification_id'])) {
+                        source.dispatchEvent(new MessageEvent(notification['type'], { 'data': JSON.stringify(notification['data']) }));
+                    }
+                });
+            }).catch((error) => {
+                console.log(error);
+            });
+    }
+
+    source.addEventListener('open', function () {
+        // The map sources only exist once the map has loaded
+        if (map.getSource('bike_pedestrian_roads')) {
+            replay();
+        } else {
+            map.once('load', replay);
+        }
+    }, false);
+}
+
 function get_road_shadow_stats(roads_shadow_stats_url) {
 
     fetch(roads_shadow_stats_url)
@@ -128,6 +209,9 @@ function get_road_shadow_stats(roads_shadow_stats_url) {
             shadowed_roads.innerHTML = roads_shadow_data['shadowed_kms']
             let total_building_shadow_cont = document.getElementById('building_shadows');
             total_building_shadow_cont.innerHTML = roads_shadow_data['total_shadow_area'];
+            if (roads_shadow_data['segment_shade_key']) {
+                set_road_shade_source(roads_shadow_data['segment_shade_key']);
+            }
             
         }).catch((error) => {
             
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import List, Union
+from typing import List, Union, Optional
 from geojson import FeatureCollection
 
 
@@ -68,6 +68,8 @@ class DrawnTreesFeatureProperties:
     base_height: float
     building_id: str
     color: str
+    # Drawn trees are shaded as a crown of this radius in metres
+    tree_crown_radius: float = 0
 
 
 @dataclass
@@ -82,6 +84,8 @@ class GeodesignhubDesignFeatureProperties:
     areatype: str
     volume_information: VolumeInformation
     tag_codes: str
+    # Set for point features and policy grids, they are shaded as trees with a crown of this radius in metres
+    tree_crown_radius: float = 0
 
 
 @dataclass
@@ -205,6 +209,10 @@ class ShadowViewSuccessResponse:
     shadow_date_time: str
     trees_wms_url: str
     view_details: Union[ToolboxDesignViewDetails, ToolboxDiagramViewDetails]
+    # Set when the shadow was already computed for the same design and time
+    cached_shadow_key: str = ""
+    # Set when a precomputed existing buildings baseline is stored close to the time
+    baseline_shadow_key: str = ""
 
 
 @dataclass
@@ -261,6 +269,21 @@ class GeodesignhubDataShadowGenerationRequest:
     session_id: str
     request_date_time: str
     bounds: str
+    shadow_engine: Optional[str] = None
+    result_key: Optional[str] = None
+    fidelity: Optional[str] = None
+
+@dataclass
+class GeodesignhubShadowSweepRequest:
+    buildings: dict
+    session_id: str
+    request_date_time: str
+    start_date_time: str
+    end_date_time: str
+    step_minutes: int
+    bounds: str
+    shadow_engine: Optional[str] = None
+
 
 @dataclass
 class DrawnTreesShadowGenerationRequest:
@@ -268,7 +291,8 @@ class DrawnTreesShadowGenerationRequest:
     session_id: str
     request_date_time: str
     processed_trees: dict
-    
+    shadow_engine: Optional[str] = None
+    fidelity: Optional[str] = None
 
 
 @dataclass
@@ -276,6 +300,18 @@ class ExistingBuildingsDataShadowGenerationRequest:
     session_id: str
     request_date_time: str
     bounds: str
+    shadow_engine: Optional[str] = None
+    tile_workers: Optional[int] = None
+    fidelity: Optional[str] = None
+
+
+@dataclass
+class BaselineShadowGenerationRequest:
+    project_id: str
+    request_date_time: str
+    bounds: str
+    shadow_engine: Optional[str] = None
+    tile_workers: Optional[int] = None
 
 
 @dataclass
@@ -312,8 +348,8 @@ class CanopyDownloadRequest:
 
 @dataclass
 class ShadowsRoadsIntersectionRequest:
-    roads: str
-    shadows: str
+    roads_key: str
+    shadows_key: str
     job_id: str
 
 
@@ -323,3 +359,13 @@ class RoadsShadowOverlap:
     shadowed_kms: float
     job_id: str
     total_shadow_area: float
+    # The shade of every road segment is stored under this key
+    segment_shade_key: str = ""
+
+
+@dataclass
+class RoadsShadowSeries:
+    job_id: str
+    total_roads_kms: float
+    date_times: List[str]
+    shadowed_kms: List[float]
@@ -20,11 +20,19 @@ from data_definitions import (
     DiagramUploadDetails,
     UploadSuccessResponse,
     DrawnTreesShadowGenerationRequest,
+    GeodesignhubShadowSweepRequest,
+    BaselineShadowGenerationRequest,
 )
 import utils
 from utils import GeometryHelper
+from shadow_cache import shadow_result_key
+from shadow_precision import keep_full_fidelity, full_fidelity_key
+from baseline_shadows import baseline_shadow_key
+from shadow_engine import get_default_tree_crown_radius
+from local_projection import LocalProjection
 from shapely.geometry.base import BaseGeometry
 from shapely.geometry import mapping, shape
+import hashlib
 import json
 from dataclasses import asdict
 from dacite import from_dict
@@ -37,6 +45,10 @@ from dataclasses import asdict
 from notifications_helper import (
     notify_shadow_complete,
     shadow_generation_failure,
+    notify_shadow_sweep_complete,
+    shadow_sweep_failure,
+    notify_roads_shadow_series_complete,
+    roads_shadow_series_failure,
     notify_roads_download_complete,
     notify_roads_download_failure,
     notify_gdh_roads_shadow_intersection_complete,
@@ -47,15 +59,20 @@ from notifications_helper import (
     notify_trees_download_failure,
     notify_buildings_download_complete,
     notify_buildings_download_failure,
+    notify_baseline_shadow_complete,
+    baseline_shadow_failure,
 )
 from uuid import uuid4
 import uuid
 from json import encoder
 from rq import Queue
-from rq.job import Dependency
+from rq.job import Dependency, Job, JobStatus
+from rq.exceptions import NoSuchJobError
+from single_flight import claim_population, take_over_population
 from worker import conn
 from config import wms_url_generator
 import arrow
+import os
 import logging
 
 logger = logging.getLogger("local-climate-response")
@@ -70,6 +87,41 @@ redis = get_redis()
 q = Queue(connection=conn)
 
 
+def layer_storage_key(bounds: str, layer: str) -> str:
+    return hashlib.sha512(bounds.encode("utf-8")).hexdigest()[:15] + ":" + layer
+
+
+def enqueue_layer_download(
+    queue: Queue, storage_key: str, f, payload: dict, job_id: str, **kwargs
+) -> Job:
+    """Enqueues the download of a layer, when another job is already downloading it the new job is deferred until that job ends instead of waiting in a worker.
+
+    The deferred job runs whether the other job succeeds or fails, it reuses the stored layer or takes the download over.
+    """
+    depends_on = None
+    if not redis.exists(storage_key):
+        holder_id = claim_population(storage_key, job_id)
+        if holder_id is not None and holder_id != job_id:
+            try:
+                holder = Job.fetch(holder_id, connection=conn)
+                holder_status = holder.get_status()
+            except NoSuchJobError:
+                holder, holder_status = None, None
+            if holder_status in [
+                JobStatus.QUEUED,
+                JobStatus.STARTED,
+                JobStatus.DEFERRED,
+                JobStatus.SCHEDULED,
+            ]:
+                logger.info(
+                    "Deferring %s until %s downloaded %s" % (job_id, holder_id, storage_key)
+                )
+                depends_on = Dependency(jobs=[holder], allow_failure=True)
+            else:
+                take_over_population(storage_key, job_id)
+    return queue.enqueue(f, payload, job_id=job_id, depends_on=depends_on, **kwargs)
+
+
 class ShapelyEncoder(json.JSONEncoder):
     """Encodes JSON strings into shapes processed by SHapely"""
 
@@ -85,13 +137,20 @@ def export_to_json(data):
     return json.loads(json.dumps(data, sort_keys=True, cls=ShapelyEncoder))
 
 
-def kickoff_drawn_trees_shadow_job(session_id: str, unprocessed_drawn_trees: dict):
+def kickoff_drawn_trees_shadow_job(
+    session_id: str,
+    unprocessed_drawn_trees: dict,
+    shadow_engine: str = None,
+    fidelity: str = None,
+):
     request_date_time = arrow.now().format("YYYY-MM-DDTHH:mm:ss")
     tree_processing_payload = DrawnTreesShadowGenerationRequest(
         trees=unprocessed_drawn_trees,
         session_id=session_id,
         request_date_time=request_date_time,
         processed_trees={},
+        shadow_engine=shadow_engine,
+        fidelity=fidelity,
     )
 
     tree_processing_job_result = q.enqueue(
@@ -279,12 +338,16 @@ class GeodesignhubDataDownloader:
                 )
                 _feature_properties.height = 0
                 _feature_properties.base_height = 0
-                for _point_feature in point_grid["features"]:
-                    _point_geometry = Polygon(
-                        coordinates=_point_feature["geometry"]["coordinates"]
-                    )
+                _feature_properties.tree_crown_radius = get_default_tree_crown_radius()
+                # The grid points stand in for tree canopies, every point shares the properties of the policy
+                _point_properties = asdict(_feature_properties)
+                _canopies = LocalProjection.from_geometries(point_grid).buffer(
+                    point_grid, get_default_tree_crown_radius()
+                )
+                for _canopy in _canopies:
+                    _point_geometry = Polygon(coordinates=mapping(_canopy)["coordinates"])
                     _feature = Feature(
-                        geometry=_point_geometry, properties=asdict(_feature_properties)
+                        geometry=_point_geometry, properties=_point_properties
                     )
                     _all_features.append(_feature)
             else:
@@ -298,8 +361,13 @@ class GeodesignhubDataDownloader:
                         coordinates=_single_diagram_feature["geometry"]["coordinates"]
                     )
                 elif _single_diagram_feature["geometry"]["type"] == "Point":
+                    _feature_properties.tree_crown_radius = (
+                        get_default_tree_crown_radius()
+                    )
                     point = shape(_single_diagram_feature["geometry"])
-                    buffered_point = point.buffer(0.00005)
+                    buffered_point = LocalProjection.from_geometries([point]).buffer(
+                        [point], get_default_tree_crown_radius()
+                    )[0]
                     buffered_polygon = export_to_json(buffered_point)
                     _geometry = Polygon(coordinates=buffered_polygon["coordinates"])
                     # Buffer the point
@@ -524,7 +592,9 @@ class RoadsDownloadFactory:
             request_date_time=self.shadow_date_time,
             roads_url=r_url,
         )
-        roads_download_result = q.enqueue(
+        roads_download_result = enqueue_layer_download(
+            q,
+            layer_storage_key(self.bounds, "roads"),
             utils.download_roads,
             asdict(roads_download_job),
             on_success=notify_roads_download_complete,
@@ -541,17 +611,23 @@ class ShadowComputationHelper:
         bounds: str,
         project_id: str,
         design_diagram_geojson=None,
+        shadow_engine: str = None,
+        fidelity: str = None,
     ):
         self.gdh_geojson = design_diagram_geojson
         self.session_id = session_id
         self.shadow_date_time = shadow_date_time
         self.bounds = bounds
         self.project_id = project_id
+        self.shadow_engine = shadow_engine
+        self.fidelity = fidelity
+        self.roads_download_result = None
 
-    def compute_gdh_buildings_shadow(self):
-        """This method computes the shadow for existing or GDH buidlings"""
+    def compute_gdh_buildings_shadow(self) -> Optional[str]:
+        """This method computes the shadow for existing or GDH buidlings, if the same design was already computed for this time the session is pointed to that result and its key is returned"""
         my_url_generator = wms_url_generator(project_id=self.project_id)
         r_url = my_url_generator.get_roads_url()
+        cached_shadow_key = None
 
         try:
             assert r_url != "0"
@@ -567,34 +643,63 @@ class ShadowComputationHelper:
                 request_date_time=self.shadow_date_time,
                 roads_url=r_url,
             )
-            roads_download_result = q.enqueue(
+            roads_download_result = enqueue_layer_download(
+                q,
+                layer_storage_key(self.bounds, "roads"),
                 utils.download_roads,
                 asdict(roads_download_job),
                 on_success=notify_roads_download_complete,
                 on_failure=notify_roads_download_failure,
                 job_id=self.session_id + ":" + self.shadow_date_time + ":roads",
             )
+            self.roads_download_result = roads_download_result
 
             gdh_buildings_shadow_dependency = Dependency(
                 jobs=[roads_download_result], allow_failure=False, enqueue_at_front=True
             )
 
-            # generate the GDH Shadows
-            gdh_worker_data = GeodesignhubDataShadowGenerationRequest(
+            result_key = shadow_result_key(
                 buildings=self.gdh_geojson,
-                session_id=self.session_id,
                 request_date_time=self.shadow_date_time,
                 bounds=self.bounds,
+                engine=self.shadow_engine,
             )
-
-            gdh_shadow_result = q.enqueue(
-                utils.compute_gdh_shadow_with_tree_canopy,
-                asdict(gdh_worker_data),
-                on_success=notify_shadow_complete,
-                on_failure=shadow_generation_failure,
-                job_id=self.session_id + ":" + self.shadow_date_time,
-                depends_on=gdh_buildings_shadow_dependency,
+            session_shadow_key = (
+                self.session_id
+                + ":"
+                + self.shadow_date_time
+                + "_gdh_buildings_canopy_shadow"
             )
+            if redis.exists(result_key) and (
+                not keep_full_fidelity(self.fidelity)
+                or redis.exists(full_fidelity_key(result_key))
+            ):
+                # The same design was computed for this time already, point the session to it
+                redis.set(session_shadow_key, result_key)
+                redis.expire(session_shadow_key, time=6000)
+                cached_shadow_key = session_shadow_key
+                roads_shadow_dependency = [roads_download_result]
+            else:
+                # generate the GDH Shadows
+                gdh_worker_data = GeodesignhubDataShadowGenerationRequest(
+                    buildings=self.gdh_geojson,
+                    session_id=self.session_id,
+                    request_date_time=self.shadow_date_time,
+                    bounds=self.bounds,
+                    shadow_engine=self.shadow_engine,
+                    result_key=result_key,
+                    fidelity=self.fidelity,
+                )
+
+                gdh_shadow_result = q.enqueue(
+                    utils.compute_gdh_shadow_with_tree_canopy,
+                    asdict(gdh_worker_data),
+                    on_success=notify_shadow_complete,
+                    on_failure=shadow_generation_failure,
+                    job_id=self.session_id + ":" + self.shadow_date_time,
+                    depends_on=gdh_buildings_shadow_dependency,
+                )
+                roads_shadow_dependency = [gdh_shadow_result]
 
             _gdh_roads_shadows_start_processing = RoadsShadowsComputationStartRequest(
                 bounds=self.bounds,
@@ -608,9 +713,56 @@ class ShadowComputationHelper:
                 on_success=notify_gdh_roads_shadow_intersection_complete,
                 on_failure=notify_gdh_roads_shadow_intersection_failure,
                 job_id=self.session_id + ":gdh_roads_shadow",
-                depends_on=[gdh_shadow_result],
+                depends_on=roads_shadow_dependency,
             )
 
+        return cached_shadow_key
+
+    def compute_gdh_buildings_shadow_sweep(
+        self, start_time: str = None, end_time: str = None, step_minutes: int = None
+    ):
+        """This method computes the GDH buildings shadow for a full day in one job so that changing the time reads from the cache, the shaded roads for the same times are computed next to it"""
+        start_time = start_time if start_time else os.getenv("SHADOW_SWEEP_START", "06:00")
+        end_time = end_time if end_time else os.getenv("SHADOW_SWEEP_END", "20:00")
+        step_minutes = (
+            step_minutes
+            if step_minutes
+            else int(os.getenv("SHADOW_SWEEP_STEP_MINUTES", 30))
+        )
+        shadow_date = arrow.get(self.shadow_date_time).format("YYYY-MM-DD")
+
+        gdh_sweep_data = GeodesignhubShadowSweepRequest(
+            buildings=self.gdh_geojson,
+            session_id=self.session_id,
+            request_date_time=self.shadow_date_time,
+            start_date_time=shadow_date + "T" + start_time,
+            end_date_time=shadow_date + "T" + end_time,
+            step_minutes=step_minutes,
+            bounds=self.bounds,
+            shadow_engine=self.shadow_engine,
+        )
+
+        shadow_sweep_result = q.enqueue(
+            utils.compute_gdh_shadow_sweep,
+            asdict(gdh_sweep_data),
+            on_success=notify_shadow_sweep_complete,
+            on_failure=shadow_sweep_failure,
+            job_id=self.session_id + ":" + self.shadow_date_time + ":sweep",
+        )
+
+        if self.roads_download_result is None:
+            logger.info("The roads are not downloaded, no shaded roads series computed")
+            return
+        # The series reads the shadows of every step from the sweep instead of computing them again
+        q.enqueue(
+            utils.compute_gdh_roads_shadow_series,
+            asdict(gdh_sweep_data),
+            on_success=notify_roads_shadow_series_complete,
+            on_failure=roads_shadow_series_failure,
+            job_id=self.session_id + ":" + self.shadow_date_time + ":roads_shadow_series",
+            depends_on=[self.roads_download_result, shadow_sweep_result],
+        )
+
     # def compute_existing_buildings_shadow(self):
     #     ''' This method computes the shadow for existing or GDH buidlings '''
 
@@ -646,3 +798,82 @@ class ShadowComputationHelper:
     #         _existing_roads_shadows_start_processing = RoadsShadowsComputationStartRequest(bounds = self.bounds, session_id= self.session_id, request_date_time= self. shadow_date_time)
 
     #         existing_roads_intersection_result = q.enqueue(utils.kickoff_existing_buildings_roads_shadows_stats, asdict(_existing_roads_shadows_start_processing), on_success= notify_existing_roads_shadow_intersection_complete, on_failure = notify_existing_roads_shadow_intersection_failure, job_id = self.session_id + ':existing_buildings_roads_shadow' , depends_on = [existing_shadow_result])
+
+
+class BaselineShadowHelper:
+    def __init__(self, project_id: str, bounds: str, shadow_engine: str = None):
+        self.project_id = project_id
+        self.bounds = bounds
+        self.shadow_engine = shadow_engine
+        self.session_id = "baseline:" + project_id
+
+    def precompute_baseline_shadows(self, reference_date_times: List[str]) -> List[str]:
+        """This method enqueues the existing buildings and canopy shadow of the project for every reference time, the layers are downloaded once for all of them"""
+        my_url_generator = wms_url_generator(project_id=self.project_id)
+        t_url = my_url_generator.get_trees_url()
+        b_url = my_url_generator.get_buildings_url()
+        baseline_keys = []
+        try:
+            assert t_url != "0"
+            assert b_url != "0"
+        except AssertionError:
+            logger.info(
+                "A Canopy and a Existing Buildings GeoJSON as a URL is expected for project %s"
+                % self.project_id
+            )
+            return baseline_keys
+
+        # Baselines are batch work, the interactive jobs on the other queues are picked up first
+        baseline_queue = Queue("low", connection=conn)
+        run_date_time = arrow.now().format("YYYY-MM-DDTHH:mm:ss")
+        trees_download_job = TreesDownloadRequest(
+            bounds=self.bounds,
+            session_id=self.session_id,
+            request_date_time=run_date_time,
+            trees_url=t_url,
+        )
+        trees_download_result = enqueue_layer_download(
+            baseline_queue,
+            layer_storage_key(self.bounds, "trees"),
+            utils.download_trees,
+            asdict(trees_download_job),
+            job_id=self.session_id + ":" + run_date_time + ":trees",
+        )
+        buildings_download_job = BuildingsDownloadRequest(
+            bounds=self.bounds,
+            session_id=self.session_id,
+            request_date_time=run_date_time,
+            buildings_url=b_url,
+        )
+        buildings_download_result = enqueue_layer_download(
+            baseline_queue,
+            layer_storage_key(self.bounds, "existing_buildings"),
+            utils.download_existing_buildings,
+            asdict(buildings_download_job),
+            job_id=self.session_id + ":" + run_date_time + ":existing_buildings",
+        )
+        baseline_shadow_dependency = Dependency(
+            jobs=[trees_download_result, buildings_download_result],
+            allow_failure=False,
+        )
+
+        for reference_date_time in reference_date_times:
+            baseline_worker_data = BaselineShadowGenerationRequest(
+                project_id=self.project_id,
+                request_date_time=reference_date_time,
+                bounds=self.bounds,
+                shadow_engine=self.shadow_engine,
+            )
+            baseline_queue.enqueue(
+                utils.compute_baseline_shadow,
+                asdict(baseline_worker_data),
+                on_success=notify_baseline_shadow_complete,
+                on_failure=baseline_shadow_failure,
+                job_id=self.session_id + ":" + reference_date_time,
+                depends_on=baseline_shadow_dependency,
+                job_timeout=int(os.getenv("BASELINE_SHADOW_JOB_TIMEOUT", 3600)),
+            )
+            baseline_keys.append(
+                baseline_shadow_key(self.bounds, reference_date_time)
+            )
+        return baseline_keys
@@ -0,0 +1,264 @@
+import json
+import struct
+import tempfile
+import uuid
+import numpy as np
+import geopandas as gpd
+import shapely
+from typing import Iterator, List, Optional, Tuple
+from value_codec import (
+    ValueCompressor,
+    encode_value,
+    decode_value,
+    VALUE_COMPRESSION_MIN_BYTES,
+)
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+# Stored layers start with a magic marker so values written as GeoJSON before can still be read
+MAGIC = b"GDHGEO"
+FORMAT_VERSION = 1
+WKB_FORMAT = "wkb"
+DEFAULT_CRS = "EPSG:4326"
+_header_length = struct.Struct("<I")
+# Layers being written are kept in memory up to this size and on disk beyond it
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+WRITE_PIECE_BYTES = 1024 * 1024
+
+
+def empty_layer() -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(geometry=[], crs=DEFAULT_CRS)
+
+
+def encode_layer(layer: gpd.GeoDataFrame, metadata: Optional[dict] = None) -> bytes:
+    """Encodes a layer as a header followed by the WKB offsets, the WKB of every geometry and the properties column by column, large layers are compressed.
+
+    The header records the format, CRS, feature count and bounds so they can be read without decoding the layer,
+    metadata about the layer as a whole is kept in it too.
+    """
+    if layer.empty:
+        layer = empty_layer()
+    geometries = layer.geometry.to_numpy()
+    wkbs = shapely.to_wkb(geometries)
+    lengths = np.array([len(w) if w is not None else 0 for w in wkbs], dtype="<u8")
+    offsets = np.concatenate([np.zeros(1, dtype="<u8"), np.cumsum(lengths, dtype="<u8")])
+    geometry_blob = b"".join(w for w in wkbs if w is not None)
+    properties = json.dumps(
+        layer.drop(columns=layer.geometry.name).to_dict(orient="list"), default=str
+    ).encode("utf-8")
+    total_bounds = shapely.total_bounds(geometries) if len(geometries) else []
+    header = json.dumps(
+        {
+            "format": WKB_FORMAT,
+            "version": FORMAT_VERSION,
+            "crs": layer.crs.to_string() if layer.crs else DEFAULT_CRS,
+            "count": len(geometries),
+            "bounds": [None if np.isnan(b) else float(b) for b in total_bounds],
+            "geometry_length": len(geometry_blob),
+            "properties_length": len(properties),
+            "metadata": metadata if metadata else {},
+        }
+    ).encode("utf-8")
+    return encode_value(
+        b"".join(
+            [
+                MAGIC,
+                _header_length.pack(len(header)),
+                header,
+                offsets.tobytes(),
+                geometry_blob,
+                properties,
+            ]
+        )
+    )
+
+
+class LayerWriter:
+    """Encodes a layer chunk by chunk in the format of encode_layer so a layer of any size is stored with bounded memory.
+
+    The WKB and the properties of every chunk are spooled to temporary files, only the offsets are kept in memory.
+    """
+
+    def __init__(self, crs: str = DEFAULT_CRS, metadata: Optional[dict] = None):
+        self.crs = crs
+        self.metadata = metadata if metadata else {}
+        self.geometry_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        self.chunks_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        self.lengths = []
+        self.columns = {}
+        self.bounds = np.array([np.inf, np.inf, -np.inf, -np.inf])
+        self.count = 0
+
+    def add(self, geometries: np.ndarray, properties: List[dict]):
+        wkbs = shapely.to_wkb(geometries)
+        self.lengths.append(
+            np.array([len(w) if w is not None else 0 for w in wkbs], dtype="<u8")
+        )
+        self.geometry_file.write(b"".join(w for w in wkbs if w is not None))
+        chunk_bounds = shapely.total_bounds(geometries)
+        self.bounds[:2] = np.fmin(self.bounds[:2], chunk_bounds[:2])
+        self.bounds[2:] = np.fmax(self.bounds[2:], chunk_bounds[2:])
+
+        chunk_columns = {}
+        for feature_properties in properties:
+            for name in feature_properties:
+                chunk_columns.setdefault(name, None)
+        self.columns.update(chunk_columns)
+        chunk = {
+            "count": len(properties),
+            "columns": {
+                name: [p.get(name) for p in properties] for name in chunk_columns
+            },
+        }
+        self.chunks_file.write(json.dumps(chunk, default=str).encode("utf-8") + b"\n")
+        self.count += len(properties)
+
+    def _write_properties(self, properties_file):
+        """Writes the properties as one JSON object of columns, every column is collected from the spooled chunks in turn"""
+        properties_file.write(b"{")
+        for column_position, name in enumerate(self.columns):
+            properties_file.write(
+                (", " if column_position else "").encode("utf-8")
+                + json.dumps(name).encode("utf-8")
+                + b": ["
+            )
+            separator = b""
+            self.chunks_file.seek(0)
+            for line in self.chunks_file:
+                chunk = json.loads(line)
+                values = chunk["columns"].get(name, [None] * chunk["count"])
+                if values:
+                    properties_file.write(separator + json.dumps(values, default=str)[1:-1].encode("utf-8"))
+                    separator = b", "
+            properties_file.write(b"]")
+        properties_file.write(b"}")
+
+    def _pieces(self, offsets: np.ndarray, properties_file) -> Iterator[bytes]:
+        offsets_bytes = memoryview(offsets.tobytes())
+        for start in range(0, len(offsets_bytes), WRITE_PIECE_BYTES):
+            yield bytes(offsets_bytes[start : start + WRITE_PIECE_BYTES])
+        for spooled_file in [self.geometry_file, properties_file]:
+            spooled_file.seek(0)
+            yield from iter(lambda: spooled_file.read(WRITE_PIECE_BYTES), b"")
+
+    def write(self, connection, key: str, ttl: int):
+        """Appends the encoded, and if it is large compressed, layer to a temporary key piece by piece and renames it to the key, readers never see a partial layer"""
+        lengths = np.concatenate(self.lengths) if self.lengths else np.zeros(0, dtype="<u8")
+        offsets = np.concatenate([np.zeros(1, dtype="<u8"), np.cumsum(lengths, dtype="<u8")])
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as properties_file:
+            self._write_properties(properties_file)
+            header = json.dumps(
+                {
+                    "format": WKB_FORMAT,
+                    "version": FORMAT_VERSION,
+                    "crs": self.crs,
+                    "count": self.count,
+                    "bounds": [
+                        None if not np.isfinite(b) else float(b) for b in self.bounds
+                    ]
+                    if self.count
+                    else [],
+                    "geometry_length": int(offsets[-1]),
+                    "properties_length": properties_file.tell(),
+                    "metadata": self.metadata,
+                }
+            ).encode("utf-8")
+
+            layer_prefix = MAGIC + _header_length.pack(len(header)) + header
+            encoded_length = (
+                len(layer_prefix)
+                + offsets.nbytes
+                + int(offsets[-1])
+                + properties_file.tell()
+            )
+            compressor = (
+                ValueCompressor()
+                if encoded_length >= VALUE_COMPRESSION_MIN_BYTES
+                else None
+            )
+
+            writing_key = key + ":writing:" + uuid.uuid4().hex
+            connection.set(
+                writing_key,
+                compressor.header() + compressor.compress(layer_prefix)
+                if compressor
+                else layer_prefix,
+                ex=ttl,
+            )
+            for piece in self._pieces(offsets, properties_file):
+                piece = compressor.compress(piece) if compressor else piece
+                if piece:
+                    connection.append(writing_key, piece)
+            if compressor:
+                connection.append(writing_key, compressor.flush())
+            connection.rename(writing_key, key)
+
+    def close(self):
+        self.geometry_file.close()
+        self.chunks_file.close()
+
+
+def is_encoded_layer(raw: bytes) -> bool:
+    return raw[: len(MAGIC)] == MAGIC
+
+
+def _read_header(raw: bytes) -> Tuple[dict, int]:
+    start = len(MAGIC) + _header_length.size
+    (header_length,) = _header_length.unpack_from(raw, len(MAGIC))
+    header = json.loads(bytes(raw[start : start + header_length]))
+    return header, start + header_length
+
+
+def read_header(raw: bytes) -> dict:
+    return _read_header(decode_value(raw))[0]
+
+
+def decode_geometries(raw: bytes) -> np.ndarray:
+    """Decodes only the geometries of a stored layer into a shapely array"""
+    raw = decode_value(raw)
+    header, start = _read_header(raw)
+    count = header["count"]
+    offsets = np.frombuffer(raw, dtype="<u8", count=count + 1, offset=start)
+    blob = memoryview(raw)[start + offsets.nbytes :]
+    wkbs = [
+        bytes(blob[begin:end]) if end > begin else None
+        for begin, end in zip(offsets[:-1], offsets[1:])
+    ]
+    return shapely.from_wkb(np.array(wkbs, dtype=object))
+
+
+def decode_layer(raw: bytes) -> gpd.GeoDataFrame:
+    raw = decode_value(raw)
+    header, start = _read_header(raw)
+    geometries = decode_geometries(raw)
+    properties_start = start + (header["count"] + 1) * 8 + header["geometry_length"]
+    properties = json.loads(
+        bytes(raw[properties_start : properties_start + header["properties_length"]])
+    )
+    return gpd.GeoDataFrame(properties, geometry=geometries, crs=header["crs"])
+
+
+def feature_collection_to_layer(feature_collection: dict) -> gpd.GeoDataFrame:
+    features = feature_collection.get("features", [])
+    if not features:
+        return empty_layer()
+    return gpd.GeoDataFrame.from_features(features, crs=DEFAULT_CRS)
+
+
+def load_layer(raw: bytes) -> gpd.GeoDataFrame:
+    """Returns a stored layer as a GeoDataFrame, layers stored as (double encoded) GeoJSON text are parsed as before"""
+    if raw is None:
+        return empty_layer()
+    raw = decode_value(raw)
+    if is_encoded_layer(raw):
+        return decode_layer(raw)
+    feature_collection = json.loads(raw)
+    if isinstance(feature_collection, str):
+        feature_collection = json.loads(feature_collection)
+    return feature_collection_to_layer(feature_collection)
+
+
+def layer_to_geojson(raw: bytes) -> str:
+    """Converts a stored layer to GeoJSON text, this is only done at the HTTP edge"""
+    return load_layer(raw).to_json()
@@ -0,0 +1,64 @@
+import json
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+from conn import get_redis
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+SESSION_NOTIFICATIONS_TTL = 6000
+
+
+def result_version_key(result_key: str) -> str:
+    return result_key + ":version"
+
+
+@contextmanager
+def commit_result(result_key: str, ttl: int):
+    """Collects the writes of a job result in one transaction that also bumps the version marker of the result.
+
+    The marker is only visible once every value of the result is, notifications check it instead of waiting.
+    """
+    pipe = r.pipeline(transaction=True)
+    yield pipe
+    bump_result_version(pipe, result_key, ttl)
+    pipe.execute()
+
+
+def bump_result_version(pipe, result_key: str, ttl: int):
+    """Writes a new version marker for a value written in the pipeline, caches of the value compare it before they are reused.
+
+    The marker is time ordered, a value that expired and is written again never gets a version it had before.
+    """
+    pipe.set(result_version_key(result_key), time.time_ns(), ex=ttl)
+
+
+def get_result_version(result_key: str) -> Optional[int]:
+    version = r.get(result_version_key(result_key))
+    return int(version) if version is not None else None
+
+
+def record_notification(session_id: str, notification_type: str, data: dict) -> int:
+    """Keeps the notifications of a session so a page that subscribes after a job finished can replay them, returns the position of the notification in the session"""
+    notifications_key = "notifications:" + session_id
+    pipe = r.pipeline()
+    pipe.rpush(notifications_key, json.dumps({"type": notification_type, "data": data}))
+    pipe.expire(notifications_key, SESSION_NOTIFICATIONS_TTL)
+    length, _ = pipe.execute()
+    return length - 1
+
+
+def get_session_notifications(session_id: str, since: int = 0) -> List[dict]:
+    """Returns the notifications of a session from the given position on, every notification carries its position so pages skip the ones they received"""
+    notifications = []
+    for notification_id, n in enumerate(
+        r.lrange("notifications:" + session_id, since, -1), start=since
+    ):
+        notification = json.loads(n)
+        notification["data"]["notification_id"] = notification_id
+        notification["data"]["session_id"] = session_id
+        notifications.append(notification)
+    return notifications
@@ -0,0 +1,168 @@
+import codecs
+import json
+import os
+import re
+import itertools
+import numpy as np
+from shapely.geometry import shape
+from typing import Callable, Iterable, Iterator, List, Optional
+from conn import get_redis
+from geometry_store import LayerWriter
+from source_cache import source_cache
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+# Features are normalized and encoded this many at a time, the parsed GeoJSON of one chunk is all that is held in memory
+INGEST_CHUNK_FEATURES = int(os.getenv("INGEST_CHUNK_FEATURES", 5000))
+
+_whitespace = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+
+class FeatureStream:
+    """Parses the features of a GeoJSON FeatureCollection one by one from chunks of its body.
+
+    Only the text of the value being parsed is buffered, when it is incomplete the buffer is doubled so large features are parsed in linear time.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.exhausted = False
+
+    def _fill(self) -> bool:
+        """Reads at least as much text as is buffered, returns False once the body is exhausted"""
+        if self.exhausted:
+            return False
+        pending = [self.buffer[self.position :]]
+        wanted = max(len(pending[0]), 1)
+        read = 0
+        while read < wanted:
+            try:
+                text = self.text_decoder.decode(next(self.chunks))
+            except StopIteration:
+                text = self.text_decoder.decode(b"", final=True)
+                self.exhausted = True
+            pending.append(text)
+            read += len(text)
+            if self.exhausted:
+                break
+        self.buffer = "".join(pending)
+        self.position = 0
+        return read > 0 or not self.exhausted
+
+    def _skip_whitespace(self):
+        while True:
+            self.position = _whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return
+            if not self._fill():
+                raise ValueError("The GeoJSON ended unexpectedly")
+
+    def peek(self) -> str:
+        self._skip_whitespace()
+        return self.buffer[self.position]
+
+    def expect(self, characters: str) -> str:
+        character = self.peek()
+        if character not in characters:
+            raise ValueError(
+                "Expected one of %s in the GeoJSON, found %s" % (characters, character)
+            )
+        self.position += 1
+        return character
+
+    def value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if (
+                end == len(self.buffer)
+                and not isinstance(value, (dict, list, str))
+                and self._fill()
+            ):
+                continue
+            self.position = end
+            return value
+
+    def features(self) -> Iterator[dict]:
+        """Yields the features of the collection, the other members are parsed and skipped"""
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            member = self.value()
+            self.expect(":")
+            if member == "features":
+                self.expect("[")
+                if self.peek() == "]":
+                    self.position += 1
+                else:
+                    while True:
+                        yield self.value()
+                        if self.expect(",]") == "]":
+                            break
+            else:
+                self.value()
+            if self.expect(",}") == "}":
+                return
+
+
+def iter_feature_chunks(
+    chunks: Iterable[bytes], chunk_features: int = INGEST_CHUNK_FEATURES
+) -> Iterator[List[dict]]:
+    features = FeatureStream(chunks).features()
+    while True:
+        feature_chunk = list(itertools.islice(features, chunk_features))
+        if not feature_chunk:
+            return
+        yield feature_chunk
+
+
+def feature_geometries(features: List[dict]) -> np.ndarray:
+    return np.array(
+        [shape(f["geometry"]) if f.get("geometry") else None for f in features],
+        dtype=object,
+    )
+
+
+def download_layer(
+    url: str,
+    storage_key: str,
+    ttl: int = 60000,
+    normalize_properties: Optional[Callable[[List[dict]], List[dict]]] = None,
+) -> bool:
+    """Streams a GeoJSON layer from the url, or from the source cache if it is not modified, into the layer store, returns False if it could not be downloaded.
+
+    The body is parsed, normalized and encoded chunk by chunk so the memory used does not grow with the size of the layer.
+    """
+    with source_cache.open(url) as body_chunks:
+        if body_chunks is None:
+            return False
+        layer_writer = LayerWriter()
+        try:
+            for feature_chunk in iter_feature_chunks(body_chunks):
+                geometries = feature_geometries(feature_chunk)
+                properties = [f.get("properties") or {} for f in feature_chunk]
+                if normalize_properties:
+                    properties = normalize_properties(properties)
+                layer_writer.add(geometries, properties)
+            layer_writer.write(r, storage_key, ttl)
+        finally:
+            layer_writer.close()
+    logger.info(
+        "Stored %s streamed features under %s"
+        % (str(layer_writer.count), storage_key)
+    )
+    return True
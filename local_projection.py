@@ -0,0 +1,105 @@
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
+from typing import Dict, Tuple
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+# Two decimals is about a kilometre, moving the center of the projection that much does not change lengths or areas measurably
+CENTER_PRECISION = 2
+MAX_CACHED_PROJECTIONS = 256
+
+_projections: Dict[Tuple[float, float], "LocalProjection"] = {}
+
+
+class LocalProjection:
+    """An azimuthal equidistant CRS centered on a project so buffers, lengths and areas are computed in metres with planar NumPy.
+
+    Projections are cached per rounded center, every job working on the same project reuses the same transformers.
+    """
+
+    def __init__(self, center_lon: float, center_lat: float):
+        self.center_lon = center_lon
+        self.center_lat = center_lat
+        self.crs = CRS.from_proj4(
+            "+proj=aeqd +lat_0={lat} +lon_0={lon} +datum=WGS84 +units=m".format(
+                lat=center_lat, lon=center_lon
+            )
+        )
+        self.to_metric_transformer = Transformer.from_crs(
+            "EPSG:4326", self.crs, always_xy=True
+        )
+        self.to_lonlat_transformer = Transformer.from_crs(
+            self.crs, "EPSG:4326", always_xy=True
+        )
+
+    @classmethod
+    def for_center(cls, center_lon: float, center_lat: float) -> "LocalProjection":
+        center = (round(center_lon, CENTER_PRECISION), round(center_lat, CENTER_PRECISION))
+        projection = _projections.get(center)
+        if projection is None:
+            if len(_projections) >= MAX_CACHED_PROJECTIONS:
+                _projections.clear()
+            projection = cls(*center)
+            _projections[center] = projection
+        return projection
+
+    @classmethod
+    def from_bounds(cls, bounds: str) -> "LocalProjection":
+        xmin, ymin, xmax, ymax = [float(b) for b in bounds.split(",")]
+        return cls.for_center((xmin + xmax) / 2, (ymin + ymax) / 2)
+
+    @classmethod
+    def from_geometries(cls, geometries) -> "LocalProjection":
+        geometries = np.asarray(geometries, dtype=object)
+        if not len(geometries):
+            return cls.for_center(0, 0)
+        xmin, ymin, xmax, ymax = shapely.total_bounds(geometries)
+        if np.isnan(xmin):
+            return cls.for_center(0, 0)
+        return cls.for_center((xmin + xmax) / 2, (ymin + ymax) / 2)
+
+    def transform_xy(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return self.to_metric_transformer.transform(x, y)
+
+    def inverse_transform_xy(
+        self, x: np.ndarray, y: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        return self.to_lonlat_transformer.transform(x, y)
+
+    def degree_spans(self, distance: float) -> Tuple[float, float]:
+        """Returns the longitude and latitude spans of a distance in metres at the center of the projection"""
+        lon, lat = self.inverse_transform_xy(
+            np.array([distance, 0.0]), np.array([0.0, distance])
+        )
+        return lon[0] - self.center_lon, lat[1] - self.center_lat
+
+    def to_metric(self, geometries) -> np.ndarray:
+        """Projects longitude / latitude geometries to the local metric CRS in one pass over all their coordinates"""
+        return shapely.transform(
+            np.asarray(geometries),
+            lambda coords: np.column_stack(self.transform_xy(coords[:, 0], coords[:, 1])),
+        )
+
+    def to_lonlat(self, geometries) -> np.ndarray:
+        return shapely.transform(
+            np.asarray(geometries),
+            lambda coords: np.column_stack(
+                self.inverse_transform_xy(coords[:, 0], coords[:, 1])
+            ),
+        )
+
+    def buffer(self, geometries, distance: float, quad_segs: int = 8) -> np.ndarray:
+        """Buffers longitude / latitude geometries by a distance in metres"""
+        return self.to_lonlat(
+            shapely.buffer(self.to_metric(geometries), distance, quad_segs=quad_segs)
+        )
+
+    def lengths(self, geometries) -> np.ndarray:
+        """Returns the length of every longitude / latitude geometry in metres"""
+        return shapely.length(self.to_metric(geometries))
+
+    def areas(self, geometries) -> np.ndarray:
+        """Returns the area of every longitude / latitude geometry in square metres"""
+        return shapely.area(self.to_metric(geometries))
@@ -1,32 +1,91 @@
 from dashboard import create_app
 from flask_sse import sse
-import time
+from job_results import get_result_version, record_notification
 import logging
 logger = logging.getLogger("local-climate-response")
 
 
+def publish_result_notification(
+    result_key: str, session_id: str, data: dict, notification_type: str
+):
+    """Publishes the notification of a job result once its version marker confirms it is readable.
+
+    The notification is also recorded for the session so that a page subscribing after the job finished gets it.
+    """
+    version = get_result_version(result_key)
+    if version is None:
+        logger.error("Result %s is not readable, no notification sent" % result_key)
+        return
+    data["version"] = version
+    # The notification is recorded first so the published one carries its position in the session
+    notification_id = record_notification(session_id, notification_type, data)
+    app, babel = create_app()
+    with app.app_context():
+        sse.publish(
+            dict(data, notification_id=notification_id, session_id=session_id),
+            type=notification_type,
+        )
+
+
 def notify_shadow_complete(job, connection, result, *args, **kwargs):
     # send a message to the room / channel that the shadows is ready
 
     job_id = job.id + "_gdh_buildings_canopy_shadow"
-    app, babel = create_app()
-    with app.app_context():
-        sse.publish({"shadow_key": job_id}, type="gdh_shadow_generation_success")
+    publish_result_notification(
+        job_id,
+        job.id.split(":")[0],
+        {"shadow_key": job_id},
+        "gdh_shadow_generation_success",
+    )
 
 
 def shadow_generation_failure(job, connection, type, value, traceback):
     logger.info("Job with %s failed.." % str(job.id))
 
 
+def notify_shadow_sweep_complete(job, connection, result, *args, **kwargs):
+    # send a message to the room / channel that the shadows for the day are ready
+
+    job_id = job.id + "_gdh_shadows"
+    shadow_hours_key = job.id + "_gdh_shadow_hours"
+    publish_result_notification(
+        job_id,
+        job.id.split(":")[0],
+        {"shadow_sweep_key": job_id, "shadow_hours_key": shadow_hours_key},
+        "gdh_shadow_sweep_success",
+    )
+
+
+def shadow_sweep_failure(job, connection, type, value, traceback):
+    logger.info("Job with %s failed.." % str(job.id))
+
+
+def notify_roads_shadow_series_complete(job, connection, result, *args, **kwargs):
+    # send a message to the room / channel that the shaded roads for the day are ready
+
+    job_id = job.id
+    publish_result_notification(
+        job_id,
+        job.id.split(":")[0],
+        {"roads_shadow_series_key": job_id},
+        "roads_shadow_series_success",
+    )
+
+
+def roads_shadow_series_failure(job, connection, type, value, traceback):
+    logger.info("Job with %s failed.." % str(job.id))
+
+
 def existing_buildings_notify_shadow_complete(job, connection, result, *args, **kwargs):
     # send a message to the room / channel that the shadows is ready
 
     job_id = job.id + "_existing_buildings_canopy_shadow"
-    app, babel = create_app()
-    with app.app_context():
-        sse.publish(
-            {"shadow_key": job_id}, type="existing_buildings_shadow_generation_success"
-        )
+    publish_result_notification(
+        job_id,
+        job.id.split(":")[0],
+        {"shadow_key": job_id},
+        "existing_buildings_shadow_generation_success",
+    )
 
 
 def existing_buildings_shadow_generation_failure(
@@ -39,10 +98,9 @@ def notify_roads_download_complete(job, connection, result, *args, **kwargs):
     # send a message to the room / channel that the shadows is ready
 
     job_id = job.id
-    app, babel = create_app()
-    with app.app_context():
-        time.sleep(3)
-        sse.publish({"roads_key": job_id}, type="roads_download_success")
+    publish_result_notification(
+        job_id, job.id.split(":")[0], {"roads_key": job_id}, "roads_download_success"
+    )
 
     logger.info("Job with id %s downloaded roads data successfully.." % str(job.id))
 
@@ -50,10 +108,13 @@ def notify_drawn_trees_shadow_complete(job, connection, result, *args, **kwargs)
     # send a message to the room / channel that the shadows is ready
 
     job_id = job.id
-    app, babel = create_app()
-    with app.app_context():
-        time.sleep(3)
-        sse.publish({"drawn_trees_shadow_job_id": job_id}, type="drawn_trees_shadow_success")
+    session_id = job.id.split(":")[0]
+    publish_result_notification(
+        session_id + "_drawn_trees_shadow",
+        session_id,
+        {"drawn_trees_shadow_job_id": job_id},
+        "drawn_trees_shadow_success",
+    )
     
     logger.info("Job with id %s for computing drawn shadow completed successfully.." % str(job.id))
 
@@ -64,7 +125,6 @@ def notify_drawn_trees_shadow_failure(job, connection, result, *args, **kwargs):
     job_id = job.id
     app, babel = create_app()
     with app.app_context():
-        time.sleep(3)
         sse.publish({"drawn_trees_shadow_key": job_id}, type="drawn_trees_shadow_failure")
 
     logger.info("Job with id %s downloaded roads data successfully.." % str(job.id))
@@ -79,9 +139,12 @@ def notify_gdh_roads_shadow_intersection_complete(
     # send a message to the room / channel that the shadows is ready
 
     job_id = job.id
-    app, babel = create_app()
-    with app.app_context():
-        sse.publish({"roads_shadow_stats_key": job_id}, type="roads_shadow_complete")
+    publish_result_notification(
+        job_id,
+        job.id.split(":")[0],
+        {"roads_shadow_stats_key": job_id},
+        "roads_shadow_complete",
+    )
 
     logger.info(
         "Job with id %s completed the shadow intersection successfully.." % str(job.id)
@@ -98,10 +161,9 @@ def notify_trees_download_complete(job, connection, result, *args, **kwargs):
     # send a message to the room / channel that the shadows is ready
 
     job_id = job.id
-    app, babel = create_app()
-    with app.app_context():
-        time.sleep(3)
-        sse.publish({"trees_key": job_id}, type="trees_download_success")
+    publish_result_notification(
+        job_id, job.id.split(":")[0], {"trees_key": job_id}, "trees_download_success"
+    )
 
     logger.info("Job with id %s downloaded trees data successfully.." % str(job.id))
 
@@ -114,15 +176,24 @@ def notify_buildings_download_complete(job, connection, result, *args, **kwargs)
     # send a message to the room / channel that the shadows is ready
 
     job_id = job.id
-    app, babel = create_app()
-    with app.app_context():
-        sse.publish(
-            {"existing_buildings_key": job_id},
-            type="existing_buildings_download_success",
-        )
+    publish_result_notification(
+        job_id,
+        job.id.split(":")[0],
+        {"existing_buildings_key": job_id},
+        "existing_buildings_download_success",
+    )
 
     logger.info("Job with id %s downloaded buildings data successfully.." % str(job.id))
 
 
 def notify_buildings_download_failure(job, connection, type, value, traceback):
     logger.info("Job with %s failed.." % str(job.id))
+
+
+def notify_baseline_shadow_complete(job, connection, result, *args, **kwargs):
+    # Baselines are not part of a session, views look them up when they open
+    logger.info("Job with id %s stored the baseline shadow in %s.." % (str(job.id), str(result)))
+
+
+def baseline_shadow_failure(job, connection, type, value, traceback):
+    logger.info("Job with %s failed.." % str(job.id))
@@ -0,0 +1,30 @@
+"""Enqueues the existing buildings and canopy baseline shadows of the configured projects.
+
+Run it from a scheduler e.g. `python precompute_baseline_shadows.py` in cron or the Heroku Scheduler, the shadows are computed by the workers.
+"""
+
+from download_helper import BaselineShadowHelper
+from baseline_shadows import get_baseline_projects, get_baseline_date_times
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+
+def precompute_baseline_shadows():
+    reference_date_times = get_baseline_date_times()
+    for project_id, bounds in get_baseline_projects().items():
+        baseline_shadow_helper = BaselineShadowHelper(
+            project_id=project_id, bounds=bounds
+        )
+        baseline_keys = baseline_shadow_helper.precompute_baseline_shadows(
+            reference_date_times
+        )
+        logger.info(
+            "Enqueued %s baseline shadows for project %s"
+            % (str(len(baseline_keys)), project_id)
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    precompute_baseline_shadows()
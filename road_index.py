@@ -0,0 +1,178 @@
+import os
+import uuid
+from collections import OrderedDict
+import numpy as np
+import geopandas as gpd
+import shapely
+from typing import Optional, Tuple
+from conn import get_redis
+from geometry_store import encode_layer, decode_layer, read_header, load_layer
+from job_results import commit_result
+from value_codec import decode_value
+from local_projection import LocalProjection
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+ROAD_INDEX_TTL = 60000
+MAX_ROAD_INDEXES = int(os.getenv("MAX_ROAD_INDEXES", 4))
+
+_road_indexes: "OrderedDict[str, Tuple[str, RoadIndex]]" = OrderedDict()
+
+
+def road_index_key(roads_storage_key: str) -> str:
+    return roads_storage_key + ":index"
+
+
+def road_index_build_key(roads_storage_key: str) -> str:
+    return road_index_key(roads_storage_key) + ":build"
+
+
+class RoadIndex:
+    """The line roads of a bounds in their local metric projection with the length of every segment and a spatial index.
+
+    Segments keep their position in the downloaded roads layer so per segment results can be joined back to it.
+    """
+
+    def __init__(
+        self,
+        segment_index: np.ndarray,
+        geometries: np.ndarray,
+        lengths: np.ndarray,
+        projection: LocalProjection,
+        feature_count: int,
+        total_length: Optional[float] = None,
+    ):
+        self.segment_index = segment_index
+        self.feature_count = feature_count
+        self.geometries = geometries
+        self.lengths = lengths
+        self.projection = projection
+        self.total_length = (
+            total_length if total_length is not None else float(lengths.sum())
+        )
+        self.tree = shapely.STRtree(geometries)
+
+    @classmethod
+    def from_layer(cls, roads: gpd.GeoDataFrame) -> "RoadIndex":
+        road_geometries = roads.geometry.to_numpy()
+        is_road = np.isin(
+            shapely.get_type_id(road_geometries),
+            [shapely.GeometryType.LINESTRING, shapely.GeometryType.MULTILINESTRING],
+        )
+        projection = LocalProjection.from_geometries(road_geometries)
+        geometries = projection.to_metric(road_geometries[is_road])
+        segment_index = np.flatnonzero(is_road)
+        # Segments are sorted along a Hilbert curve so neighbouring roads are stored and indexed together
+        if len(geometries):
+            order = np.argsort(
+                gpd.GeoSeries(geometries).hilbert_distance().to_numpy(), kind="stable"
+            )
+            geometries = geometries[order]
+            segment_index = segment_index[order]
+        return cls(
+            segment_index=segment_index,
+            geometries=geometries,
+            lengths=shapely.length(geometries),
+            projection=projection,
+            feature_count=len(roads),
+        )
+
+    def encode(self) -> bytes:
+        return encode_layer(
+            gpd.GeoDataFrame(
+                {"segment_index": self.segment_index, "length": self.lengths},
+                geometry=list(self.geometries),
+                crs=self.projection.crs,
+            ),
+            metadata={
+                "center_lon": self.projection.center_lon,
+                "center_lat": self.projection.center_lat,
+                "total_length": self.total_length,
+                "feature_count": self.feature_count,
+            },
+        )
+
+    @classmethod
+    def decode(cls, raw: bytes) -> "RoadIndex":
+        raw = decode_value(raw)
+        metadata = read_header(raw)["metadata"]
+        layer = decode_layer(raw)
+        return cls(
+            segment_index=np.asarray(layer["segment_index"], dtype=np.int64),
+            geometries=layer.geometry.to_numpy(),
+            lengths=np.asarray(layer["length"], dtype=float),
+            projection=LocalProjection.for_center(
+                metadata["center_lon"], metadata["center_lat"]
+            ),
+            feature_count=metadata["feature_count"],
+            total_length=metadata["total_length"],
+        )
+
+    def intersect(self, shadows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the position of every road that intersects a shadow and the length of that intersection in metres.
+
+        The shadows are given in longitude / latitude, only they are projected per request.
+        """
+        metric_shadows = self.projection.to_metric(shadows)
+        shadow_position, road_position = self.tree.query(
+            metric_shadows, predicate="intersects"
+        )
+        intersections = shapely.intersection(
+            self.geometries[road_position], metric_shadows[shadow_position]
+        )
+        return road_position, shapely.length(intersections)
+
+    def segment_shade(
+        self, road_position: np.ndarray, intersection_lengths: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the shaded metres and the shaded fraction of every feature of the roads layer, NaN for features that are not lines"""
+        shaded = np.bincount(
+            road_position, weights=intersection_lengths, minlength=len(self.geometries)
+        )
+        fraction = np.divide(
+            shaded, self.lengths, out=np.zeros_like(shaded), where=self.lengths > 0
+        )
+        shaded_metres = np.full(self.feature_count, np.nan)
+        shaded_fraction = np.full(self.feature_count, np.nan)
+        shaded_metres[self.segment_index] = shaded
+        shaded_fraction[self.segment_index] = np.minimum(fraction, 1)
+        return shaded_metres, shaded_fraction
+
+
+def build_road_index(roads_storage_key: str) -> Tuple[str, RoadIndex]:
+    """Builds the index of the stored roads and stores it next to them, the build id lets workers notice a rebuild"""
+    road_index = RoadIndex.from_layer(load_layer(r.get(roads_storage_key)))
+    index_key = road_index_key(roads_storage_key)
+    build_id = uuid.uuid4().hex
+    with commit_result(index_key, ttl=ROAD_INDEX_TTL) as pipe:
+        pipe.set(index_key, road_index.encode(), ex=ROAD_INDEX_TTL)
+        pipe.set(road_index_build_key(roads_storage_key), build_id, ex=ROAD_INDEX_TTL)
+    logger.info(
+        "Built the index of %s road segments for %s"
+        % (str(len(road_index.geometries)), roads_storage_key)
+    )
+    return build_id, road_index
+
+
+def get_road_index(roads_storage_key: str) -> RoadIndex:
+    """Returns the road index of the stored roads, it is parsed once per worker and built when it is missing"""
+    build_id = r.get(road_index_build_key(roads_storage_key))
+    if build_id is not None and roads_storage_key in _road_indexes:
+        cached_build_id, road_index = _road_indexes[roads_storage_key]
+        if cached_build_id == build_id.decode("utf-8"):
+            _road_indexes.move_to_end(roads_storage_key)
+            return road_index
+
+    raw = r.get(road_index_key(roads_storage_key)) if build_id is not None else None
+    if raw is None:
+        build_id, road_index = build_road_index(roads_storage_key)
+    else:
+        build_id = build_id.decode("utf-8")
+        road_index = RoadIndex.decode(raw)
+    _road_indexes[roads_storage_key] = (build_id, road_index)
+    while len(_road_indexes) > MAX_ROAD_INDEXES:
+        _road_indexes.popitem(last=False)
+    return road_index
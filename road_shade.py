@@ -0,0 +1,74 @@
+import hashlib
+import json
+import struct
+import numpy as np
+import geopandas as gpd
+from typing import Tuple
+from conn import get_redis
+from geometry_store import load_layer
+from value_codec import encode_value, decode_value
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+# Segment shade is stored as two float32 arrays in the order of the downloaded roads layer
+MAGIC = b"GDHSHD"
+_header_length = struct.Struct("<I")
+SHADED_METRES = "shaded_metres"
+SHADED_FRACTION = "shaded_fraction"
+
+
+def segment_shade_key(roads_key: str, shadows_key: str) -> str:
+    """The shade of the segments depends only on the roads and the shadows, sessions sharing them share the result"""
+    return (
+        "road_shade:"
+        + hashlib.sha1((roads_key + "|" + shadows_key).encode("utf-8")).hexdigest()
+    )
+
+
+def encode_segment_shade(
+    roads_key: str, shaded_metres: np.ndarray, shaded_fraction: np.ndarray
+) -> bytes:
+    header = json.dumps(
+        {"roads_key": roads_key, "count": len(shaded_metres)}
+    ).encode("utf-8")
+    return encode_value(
+        b"".join(
+            [
+                MAGIC,
+                _header_length.pack(len(header)),
+                header,
+                shaded_metres.astype("<f4").tobytes(),
+                shaded_fraction.astype("<f4").tobytes(),
+            ]
+        )
+    )
+
+
+def decode_segment_shade(raw: bytes) -> Tuple[dict, np.ndarray, np.ndarray]:
+    raw = decode_value(raw)
+    start = len(MAGIC) + _header_length.size
+    (header_length,) = _header_length.unpack_from(raw, len(MAGIC))
+    header = json.loads(bytes(raw[start : start + header_length]))
+    count = header["count"]
+    offset = start + header_length
+    shaded_metres = np.frombuffer(raw, dtype="<f4", count=count, offset=offset)
+    shaded_fraction = np.frombuffer(
+        raw, dtype="<f4", count=count, offset=offset + count * 4
+    )
+    return header, shaded_metres, shaded_fraction
+
+
+def load_road_shade_layer(raw: bytes) -> gpd.GeoDataFrame:
+    """Joins the stored segment shade to the roads it was computed for, segments that are not lines are dropped"""
+    header, shaded_metres, shaded_fraction = decode_segment_shade(raw)
+    roads = load_layer(r.get(header["roads_key"]))
+    if len(roads) != header["count"]:
+        logger.error("The roads for %s changed since their shade was computed" % header["roads_key"])
+        return roads.iloc[0:0]
+    roads = roads[["geometry"]].copy()
+    roads[SHADED_METRES] = np.round(shaded_metres.astype(float), 2)
+    roads[SHADED_FRACTION] = np.round(shaded_fraction.astype(float), 3)
+    return roads[~np.isnan(shaded_fraction)]
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from typing import List, Optional
+from conn import get_redis
+from solar_ephemeris import SolarEphemeris
+from shadow_engine import (
+    compute_building_shadows,
+    empty_shadows,
+    get_default_shadow_engine,
+    get_tree_shadow_mode,
+    resolve_shadow_engine,
+    PYBDSHADOW_ENGINE,
+    SHADOW_COLUMNS,
+    TREE_CROWN_RADIUS,
+)
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+BUILDING_SHADOW_CACHE_TTL = 60000
+SHADOW_RESULT_CACHE_TTL = 60000
+
+
+def building_shadow_cache_keys(
+    buildings: gpd.GeoDataFrame, sun_position: dict, engine: str
+) -> List[str]:
+    """Returns a cache key per building from its geometry, height, base height, crown radius, the sun position and how its shadow is computed"""
+    sun = "{azimuth:.6f},{altitude:.6f}".format(**sun_position)
+    # Trees are shaded in closed form or extruded depending on the mode, both give different shadows
+    method = "{engine},{mode}".format(engine=engine, mode=get_tree_shadow_mode())
+    footprints = shapely.to_wkb(buildings.geometry.to_numpy(), output_dimension=2)
+    base_heights = (
+        buildings["base_height"] if "base_height" in buildings else np.zeros(len(buildings))
+    )
+    crown_radii = (
+        buildings[TREE_CROWN_RADIUS].fillna(0)
+        if TREE_CROWN_RADIUS in buildings
+        else np.zeros(len(buildings))
+    )
+    keys = []
+    for footprint, height, base_height, crown_radius in zip(
+        footprints, buildings["height"], base_heights, crown_radii
+    ):
+        building_hash = hashlib.sha1(footprint)
+        building_hash.update(
+            "{height:.3f},{base_height:.3f},{crown_radius:.3f},{sun},{method}".format(
+                height=float(height),
+                base_height=float(base_height),
+                crown_radius=float(crown_radius),
+                sun=sun,
+                method=method,
+            ).encode("utf-8")
+        )
+        keys.append("building_shadow:" + building_hash.hexdigest())
+    return keys
+
+
+def compute_incremental_building_shadows(
+    buildings: gpd.GeoDataFrame,
+    date_time: pd.Timestamp,
+    bounds: str,
+    engine: Optional[str] = None,
+) -> gpd.GeoDataFrame:
+    """Computes the ground shadows of the buildings, reusing the cached shadow of every building that has not changed.
+
+    The sun position is taken from the project ephemeris rather than the center of the buildings so that it and the
+    cache keys stay the same when a single diagram is edited. pybdshadow computes its own sun position so its shadows
+    are not cached per building.
+    """
+    engine = resolve_shadow_engine(engine)
+    if engine == PYBDSHADOW_ENGINE:
+        return compute_building_shadows(buildings, date_time, engine=engine)
+
+    sun_position = SolarEphemeris.from_bounds(bounds).get_position(date_time)
+    if sun_position["altitude"] < 0:
+        raise ValueError("Given time before sunrise or after sunset")
+
+    buildings = buildings[buildings["height"] > 0].reset_index(drop=True)
+    if buildings.empty:
+        return empty_shadows()
+
+    cache_keys = building_shadow_cache_keys(buildings, sun_position, engine)
+    cached_shadows = r.mget(cache_keys)
+    is_cached = np.array([s is not None for s in cached_shadows])
+
+    building_ids = list(buildings.loc[is_cached, "building_id"])
+    shadows = list(
+        shapely.from_wkb([s for s in cached_shadows if s is not None])
+    )
+
+    changed_buildings = buildings[~is_cached]
+    if not changed_buildings.empty:
+        changed_shadows = compute_building_shadows(
+            changed_buildings, date_time, engine=engine, sun_position=sun_position
+        )
+        changed_shadow_by_id = dict(
+            zip(changed_shadows["building_id"], changed_shadows.geometry)
+        )
+        pipe = r.pipeline()
+        for cache_key, building_id in zip(
+            np.array(cache_keys)[~is_cached], changed_buildings["building_id"]
+        ):
+            changed_shadow = changed_shadow_by_id.get(building_id)
+            if changed_shadow is None:
+                continue
+            pipe.set(
+                cache_key, shapely.to_wkb(changed_shadow), ex=BUILDING_SHADOW_CACHE_TTL
+            )
+            building_ids.append(building_id)
+            shadows.append(changed_shadow)
+        pipe.execute()
+
+    logger.info(
+        "Reused %s cached building shadows and computed %s"
+        % (str(is_cached.sum()), str(len(changed_buildings)))
+    )
+    if not shadows:
+        return empty_shadows()
+    ground_shadow = gpd.GeoDataFrame(
+        {"building_id": building_ids, "geometry": shadows}, geometry="geometry"
+    )
+    ground_shadow["height"] = 0
+    ground_shadow["type"] = "ground"
+    return ground_shadow[SHADOW_COLUMNS]
+
+
+def shadow_result_key(
+    buildings: dict, request_date_time: str, bounds: str, engine: Optional[str] = None
+) -> str:
+    """Returns a content addressed key for the shadow of a design FeatureCollection at a time.
+
+    Building ids are generated per session so only the geometry, the heights and the crown radius of every feature are hashed.
+    """
+    engine = engine if engine else get_default_shadow_engine()
+    design_content = [
+        [
+            f["geometry"],
+            f["properties"].get("height"),
+            f["properties"].get("base_height"),
+            f["properties"].get(TREE_CROWN_RADIUS),
+        ]
+        for f in buildings["features"]
+    ]
+    content_hash = hashlib.sha256(
+        json.dumps(
+            [design_content, request_date_time, bounds, engine, get_tree_shadow_mode()],
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+    return "shadow_result:" + content_hash
@@ -0,0 +1,373 @@
+import math
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pybdshadow
+from suncalc import get_position
+from local_projection import LocalProjection
+from typing import Iterator, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+PYBDSHADOW_ENGINE = "pybdshadow"
+VECTORIZED_ENGINE = "vectorized"
+SHADOW_ENGINES = [PYBDSHADOW_ENGINE, VECTORIZED_ENGINE]
+
+SHADOW_COLUMNS = ["building_id", "geometry", "height", "type"]
+
+ANALYTIC_TREE_SHADOWS = "analytic"
+PRISM_TREE_SHADOWS = "prism"
+TREE_SHADOW_MODES = [ANALYTIC_TREE_SHADOWS, PRISM_TREE_SHADOWS]
+# Features with a crown radius are trees, the rest are extruded footprints
+TREE_CROWN_RADIUS = "tree_crown_radius"
+
+
+def get_default_shadow_engine() -> str:
+    """Returns the shadow engine configured for this deployment"""
+    engine = os.getenv("SHADOW_ENGINE", VECTORIZED_ENGINE)
+    if engine not in SHADOW_ENGINES:
+        logger.error("Unknown shadow engine %s, using %s" % (engine, VECTORIZED_ENGINE))
+        engine = VECTORIZED_ENGINE
+    return engine
+
+
+def resolve_shadow_engine(engine: Optional[str] = None) -> str:
+    """Returns the engine a job asked for or the configured one, an engine that does not exist is an error"""
+    engine = engine if engine else get_default_shadow_engine()
+    if engine not in SHADOW_ENGINES:
+        raise ValueError(
+            "Unknown shadow engine %s, use one of %s" % (engine, ", ".join(SHADOW_ENGINES))
+        )
+    return engine
+
+
+def get_tree_shadow_mode() -> str:
+    """Returns whether trees are shaded in closed form or extruded like buildings"""
+    mode = os.getenv("TREE_SHADOW_MODE", ANALYTIC_TREE_SHADOWS)
+    if mode not in TREE_SHADOW_MODES:
+        logger.error("Unknown tree shadow mode %s, using %s" % (mode, ANALYTIC_TREE_SHADOWS))
+        mode = ANALYTIC_TREE_SHADOWS
+    return mode
+
+
+def get_default_tree_crown_radius() -> float:
+    return float(os.getenv("TREE_CROWN_RADIUS", 4))
+
+
+def empty_shadows() -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(columns=SHADOW_COLUMNS, geometry="geometry")
+
+
+def split_trees(
+    buildings: gpd.GeoDataFrame, tree_shadow_mode: Optional[str] = None
+) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    """Separates the features modelled as trees from the buildings when tree shadows are computed in closed form"""
+    tree_shadow_mode = tree_shadow_mode if tree_shadow_mode else get_tree_shadow_mode()
+    if (
+        tree_shadow_mode != ANALYTIC_TREE_SHADOWS
+        or TREE_CROWN_RADIUS not in buildings
+    ):
+        return buildings, buildings.iloc[0:0]
+    is_tree = buildings[TREE_CROWN_RADIUS].fillna(0).to_numpy(dtype=float) > 0
+    return buildings[~is_tree], buildings[is_tree]
+
+
+def combine_shadows(shadows: List[gpd.GeoDataFrame]) -> gpd.GeoDataFrame:
+    shadows = [s for s in shadows if not s.empty]
+    if not shadows:
+        return empty_shadows()
+    if len(shadows) == 1:
+        return shadows[0]
+    return pd.concat(shadows, ignore_index=True)
+
+
+def compute_building_shadows(
+    buildings: gpd.GeoDataFrame,
+    date_time: pd.Timestamp,
+    engine: Optional[str] = None,
+    sun_position: Optional[dict] = None,
+) -> gpd.GeoDataFrame:
+    """Computes the ground shadows of the buildings with the selected engine, the output has the same shape as pybdshadow.bdshadow_sunlight.
+
+    A sun position can be given so that shadows computed for different subsets of the buildings line up, pybdshadow always computes its own.
+    """
+    engine = resolve_shadow_engine(engine)
+    buildings, trees = split_trees(buildings)
+    if buildings.empty:
+        building_shadows = empty_shadows()
+    elif engine == PYBDSHADOW_ENGINE:
+        building_shadows = pybdshadow.bdshadow_sunlight(buildings, date_time)
+    else:
+        building_shadows = PreparedBuildings(buildings).shadows_at(
+            date_time, sun_position=sun_position
+        )
+    if trees.empty:
+        return building_shadows
+    tree_shadows = PreparedTrees(trees).shadows_at(date_time, sun_position=sun_position)
+    return combine_shadows([building_shadows, tree_shadows])
+
+
+class PreparedBuildings:
+    """Holds the parsed footprints of a set of buildings so that shadows can be projected for many sun positions without parsing them again"""
+
+    def __init__(self, buildings: gpd.GeoDataFrame, height="height", ground=0):
+        building = buildings.copy()
+        building[height] = building[height] - ground
+        building = building[building[height] > 0]
+        building = building.explode(index_parts=False)
+        is_polygon = building.geometry.geom_type == "Polygon"
+        if not is_polygon.all():
+            logger.info(
+                "Skipping %s non-polygon features in shadow computation"
+                % str((~is_polygon).sum())
+            )
+            building = building[is_polygon]
+
+        self.crs = building.crs
+        self.building_ids = building["building_id"].to_numpy()
+        self.footprints = building.geometry.to_numpy()
+        self.heights = building[height].to_numpy(dtype=float)
+        self.is_empty = len(self.footprints) == 0
+        if self.is_empty:
+            return
+
+        lon1, lat1, lon2, lat2 = list(building.bounds.mean())
+        self.center_lon = (lon1 + lon2) / 2
+        self.center_lat = (lat1 + lat2) / 2
+
+        rings = shapely.get_exterior_ring(self.footprints)
+        self.coords, self.ring_index = shapely.get_coordinates(
+            rings, return_index=True
+        )
+        self.projection = LocalProjection.for_center(self.center_lon, self.center_lat)
+        self.x, self.y = self.projection.transform_xy(
+            self.coords[:, 0], self.coords[:, 1]
+        )
+        hull_index = np.concatenate([self.ring_index, self.ring_index])
+        self.hull_order = np.argsort(hull_index, kind="stable")
+        self.hull_index = hull_index[self.hull_order]
+
+        footprint_areas = shapely.area(self.footprints)
+        hull_areas = shapely.area(shapely.convex_hull(self.footprints))
+        self.concave = np.flatnonzero(footprint_areas < hull_areas * (1 - 1e-9))
+        # Each wall is the segment between consecutive vertices of the same ring
+        is_wall = self.ring_index[:-1] == self.ring_index[1:]
+        self.wall_start = np.flatnonzero(is_wall)
+        wall_building = self.ring_index[self.wall_start]
+        self.concave_wall_starts = np.searchsorted(wall_building, self.concave)
+        self.concave_wall_ends = np.searchsorted(
+            wall_building, self.concave, side="right"
+        )
+
+    def get_sun_position(self, date_time: pd.Timestamp) -> dict:
+        return get_position(date_time, self.center_lon, self.center_lat)
+
+    def project_shadows(self, sun_position: dict) -> np.ndarray:
+        """Projects the shadow of every footprint extruded to its height in one pass over all the vertices.
+
+        The shadow of a prism is the union of the footprint, the footprint translated by the shadow vector and the
+        walls swept in between. For convex footprints that union is the convex hull of both vertex sets, so only
+        concave footprints need a union of their wall quads.
+        """
+        distance = self.heights[self.ring_index] / math.tan(sun_position["altitude"])
+        shifted_x = self.x + distance * math.sin(sun_position["azimuth"])
+        shifted_y = self.y + distance * math.cos(sun_position["azimuth"])
+        shifted_lon, shifted_lat = self.projection.inverse_transform_xy(
+            shifted_x, shifted_y
+        )
+        shifted = np.column_stack([shifted_lon, shifted_lat])
+
+        hull_points = shapely.multipoints(
+            np.concatenate([self.coords, shifted])[self.hull_order],
+            indices=self.hull_index,
+        )
+        shadows = shapely.convex_hull(hull_points)
+
+        if len(self.concave):
+            wall_start = self.wall_start
+            wall_quads = np.stack(
+                [
+                    self.coords[wall_start],
+                    self.coords[wall_start + 1],
+                    shifted[wall_start + 1],
+                    shifted[wall_start],
+                    self.coords[wall_start],
+                ],
+                axis=1,
+            )
+            wall_polygons = shapely.polygons(wall_quads)
+            for building_index, start, end in zip(
+                self.concave, self.concave_wall_starts, self.concave_wall_ends
+            ):
+                shadows[building_index] = shapely.union_all(
+                    np.concatenate(
+                        [
+                            wall_polygons[start:end],
+                            self.footprints[building_index : building_index + 1],
+                        ]
+                    )
+                )
+
+        return shadows
+
+    def shadows_at(
+        self, date_time: pd.Timestamp, sun_position: Optional[dict] = None
+    ) -> gpd.GeoDataFrame:
+        """Returns the ground shadows at the given time in the same shape as pybdshadow.bdshadow_sunlight"""
+        if self.is_empty:
+            return empty_shadows()
+        if sun_position is None:
+            sun_position = self.get_sun_position(date_time)
+        if sun_position["altitude"] < 0:
+            raise ValueError("Given time before sunrise or after sunset")
+
+        ground_shadow = gpd.GeoDataFrame(
+            {
+                "building_id": self.building_ids,
+                "geometry": self.project_shadows(sun_position),
+            },
+            geometry="geometry",
+            crs=self.crs,
+        )
+        # Multipart buildings are merged back into one shadow per building like pybdshadow does
+        if ground_shadow["building_id"].duplicated().any():
+            ground_shadow = ground_shadow.dissolve(by="building_id").reset_index()
+        ground_shadow = ground_shadow.sort_values(by="building_id").reset_index(
+            drop=True
+        )
+        ground_shadow["height"] = 0
+        ground_shadow["type"] = "ground"
+
+        return ground_shadow[SHADOW_COLUMNS]
+
+
+class PreparedTrees:
+    """Holds trees as a center, a crown radius and a height so the shadows of all of them are computed in closed form.
+
+    The crown is a sphere whose top is at the height of the tree, its shadow on the ground is an ellipse that is
+    stretched by 1 / sin(altitude) away from the sun. Tree polygons are reduced to their centroid.
+    """
+
+    def __init__(
+        self,
+        trees: gpd.GeoDataFrame,
+        height="height",
+        crown_radius=TREE_CROWN_RADIUS,
+        vertices: Optional[int] = None,
+    ):
+        trees = trees[trees[height] > 0]
+        self.crs = trees.crs
+        self.building_ids = trees["building_id"].to_numpy()
+        self.heights = trees[height].to_numpy(dtype=float)
+        self.vertices = (
+            vertices if vertices else int(os.getenv("TREE_SHADOW_VERTICES", 16))
+        )
+        self.is_empty = len(trees) == 0
+        if self.is_empty:
+            return
+
+        if crown_radius in trees:
+            crown_radii = trees[crown_radius].fillna(0).to_numpy(dtype=float)
+        else:
+            crown_radii = np.zeros(len(trees))
+        crown_radii[crown_radii <= 0] = get_default_tree_crown_radius()
+        # The crown sits on the trunk, it cannot reach below the ground
+        self.crown_radii = np.minimum(crown_radii, self.heights / 2)
+
+        centers = shapely.centroid(trees.geometry.to_numpy())
+        lon = shapely.get_x(centers)
+        lat = shapely.get_y(centers)
+        self.center_lon = (lon.min() + lon.max()) / 2
+        self.center_lat = (lat.min() + lat.max()) / 2
+        self.projection = LocalProjection.for_center(self.center_lon, self.center_lat)
+        self.x, self.y = self.projection.transform_xy(lon, lat)
+
+        angles = np.linspace(0, 2 * math.pi, self.vertices, endpoint=False)
+        self.cos_angles = np.cos(angles)
+        self.sin_angles = np.sin(angles)
+
+    def get_sun_position(self, date_time: pd.Timestamp) -> dict:
+        return get_position(date_time, self.center_lon, self.center_lat)
+
+    def project_shadows(self, sun_position: dict) -> np.ndarray:
+        """Returns the crown shadow of every tree as a polygon with the configured number of vertices"""
+        altitude = sun_position["altitude"]
+        shadow_x = math.sin(sun_position["azimuth"])
+        shadow_y = math.cos(sun_position["azimuth"])
+        distance = (self.heights - self.crown_radii) / math.tan(altitude)
+        center_x = self.x + distance * shadow_x
+        center_y = self.y + distance * shadow_y
+
+        along = (self.crown_radii / math.sin(altitude))[:, None] * self.cos_angles
+        across = self.crown_radii[:, None] * self.sin_angles
+        x = center_x[:, None] + along * shadow_x - across * shadow_y
+        y = center_y[:, None] + along * shadow_y + across * shadow_x
+        lon, lat = self.projection.inverse_transform_xy(x.ravel(), y.ravel())
+
+        rings = np.stack([lon, lat], axis=-1).reshape(len(self.x), self.vertices, 2)
+        rings = np.concatenate([rings, rings[:, :1]], axis=1)
+        return shapely.polygons(rings)
+
+    def shadows_at(
+        self, date_time: pd.Timestamp, sun_position: Optional[dict] = None
+    ) -> gpd.GeoDataFrame:
+        """Returns the ground shadows at the given time in the same shape as pybdshadow.bdshadow_sunlight"""
+        if self.is_empty:
+            return empty_shadows()
+        if sun_position is None:
+            sun_position = self.get_sun_position(date_time)
+        if sun_position["altitude"] < 0:
+            raise ValueError("Given time before sunrise or after sunset")
+
+        ground_shadow = gpd.GeoDataFrame(
+            {
+                "building_id": self.building_ids,
+                "geometry": self.project_shadows(sun_position),
+            },
+            geometry="geometry",
+            crs=self.crs,
+        )
+        ground_shadow["height"] = 0
+        ground_shadow["type"] = "ground"
+
+        return ground_shadow[SHADOW_COLUMNS]
+
+
+def compute_building_shadows_series(
+    buildings: gpd.GeoDataFrame,
+    date_times: List[pd.Timestamp],
+    engine=None,
+    sun_positions: Optional[List[dict]] = None,
+) -> Iterator[Tuple[pd.Timestamp, gpd.GeoDataFrame]]:
+    """Yields the ground shadows for every time in the series, the buildings are parsed once and times when the sun is below the horizon are skipped"""
+    engine = resolve_shadow_engine(engine)
+    if sun_positions is None:
+        sun_positions = [None] * len(date_times)
+    buildings, trees = split_trees(buildings)
+    if engine != PYBDSHADOW_ENGINE and not buildings.empty:
+        prepared_buildings = PreparedBuildings(buildings)
+    prepared_trees = PreparedTrees(trees)
+    for date_time, sun_position in zip(date_times, sun_positions):
+        try:
+            if buildings.empty:
+                shadows = empty_shadows()
+            elif engine == PYBDSHADOW_ENGINE:
+                shadows = pybdshadow.bdshadow_sunlight(buildings, date_time)
+            else:
+                shadows = prepared_buildings.shadows_at(
+                    date_time, sun_position=sun_position
+                )
+            if not prepared_trees.is_empty:
+                shadows = combine_shadows(
+                    [
+                        shadows,
+                        prepared_trees.shadows_at(date_time, sun_position=sun_position),
+                    ]
+                )
+        except ValueError:
+            logger.info("Sun is below the horizon at %s, skipping" % str(date_time))
+            continue
+        yield date_time, shadows
@@ -0,0 +1,104 @@
+import math
+import os
+import numpy as np
+import shapely
+from pyproj import Transformer
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+# The COG protocol used by the map only renders Web Mercator rasters
+WEB_MERCATOR = "EPSG:3857"
+
+
+class ShadowHoursGrid:
+    """A fixed Web Mercator grid over the project bounds that accumulates the number of hours every cell is in shadow"""
+
+    def __init__(self, bounds: str, resolution: float = None):
+        resolution = (
+            resolution
+            if resolution
+            else float(os.getenv("SHADOW_HOURS_RESOLUTION", 5))
+        )
+        xmin, ymin, xmax, ymax = [float(b) for b in bounds.split(",")]
+        self.to_web_mercator = Transformer.from_crs(
+            "EPSG:4326", WEB_MERCATOR, always_xy=True
+        )
+        (self.left, self.right), (self.bottom, self.top) = (
+            self.to_web_mercator.transform([xmin, xmax], [ymin, ymax])
+        )
+        # Web Mercator stretches distances by 1 / cos(latitude), scale the cell so it is about resolution metres on the ground
+        center_lat = (ymin + ymax) / 2
+        self.cell_size = resolution / math.cos(math.radians(center_lat))
+        # Large bounds get a coarser grid so that the raster stays within the memory budget
+        max_cells = int(os.getenv("SHADOW_HOURS_MAX_CELLS", 16000000))
+        cells = (self.right - self.left) * (self.top - self.bottom) / self.cell_size**2
+        if cells > max_cells:
+            self.cell_size = self.cell_size * math.sqrt(cells / max_cells)
+            logger.info(
+                "Shadow hours grid coarsened to %.1f m cells"
+                % (self.cell_size * math.cos(math.radians(center_lat)))
+            )
+        self.width = max(1, math.ceil((self.right - self.left) / self.cell_size))
+        self.height = max(1, math.ceil((self.top - self.bottom) / self.cell_size))
+        self.x_centers = self.left + (np.arange(self.width) + 0.5) * self.cell_size
+        self.y_centers = self.top - (np.arange(self.height) + 0.5) * self.cell_size
+        self.hours = np.zeros((self.height, self.width), dtype=np.float32)
+
+    def rasterize(self, shadows: np.ndarray) -> np.ndarray:
+        """Returns a mask of the cells whose centers are covered by the shadow geometries (in WGS84)"""
+        in_shadow = np.zeros(self.hours.shape, dtype=bool)
+        shadows = shapely.transform(
+            shadows,
+            lambda coords: np.column_stack(
+                self.to_web_mercator.transform(coords[:, 0], coords[:, 1])
+            ),
+        )
+        parts = shapely.get_parts(shadows)
+        parts = parts[~shapely.is_empty(parts)]
+        if len(parts) == 0:
+            return in_shadow
+        part_bounds = shapely.bounds(parts)
+        first_cols = np.floor((part_bounds[:, 0] - self.left) / self.cell_size)
+        last_cols = np.ceil((part_bounds[:, 2] - self.left) / self.cell_size)
+        first_rows = np.floor((self.top - part_bounds[:, 3]) / self.cell_size)
+        last_rows = np.ceil((self.top - part_bounds[:, 1]) / self.cell_size)
+        first_cols = np.clip(first_cols, 0, self.width).astype(int)
+        last_cols = np.clip(last_cols, 0, self.width).astype(int)
+        first_rows = np.clip(first_rows, 0, self.height).astype(int)
+        last_rows = np.clip(last_rows, 0, self.height).astype(int)
+
+        shapely.prepare(parts)
+        # Only the cells inside the bounding box of every part are tested
+        for part, col0, col1, row0, row1 in zip(
+            parts, first_cols, last_cols, first_rows, last_rows
+        ):
+            if col0 >= col1 or row0 >= row1:
+                continue
+            xx, yy = np.meshgrid(
+                self.x_centers[col0:col1], self.y_centers[row0:row1]
+            )
+            in_shadow[row0:row1, col0:col1] |= shapely.contains_xy(part, xx, yy)
+        return in_shadow
+
+    def add_shadows(self, shadows: np.ndarray, hours: float):
+        self.hours[self.rasterize(shadows)] += hours
+
+    def to_cog(self) -> bytes:
+        """Writes the accumulated hours as a Cloud-Optimized GeoTIFF"""
+        transform = from_origin(self.left, self.top, self.cell_size, self.cell_size)
+        with MemoryFile() as memfile:
+            with memfile.open(
+                driver="COG",
+                width=self.width,
+                height=self.height,
+                count=1,
+                dtype="float32",
+                crs=WEB_MERCATOR,
+                transform=transform,
+                compress="DEFLATE",
+            ) as dst:
+                dst.write(self.hours, 1)
+            return memfile.read()
@@ -0,0 +1,75 @@
+import os
+import geopandas as gpd
+import shapely
+from typing import Optional
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+# The unreduced shadow is stored next to the reduced one under this suffix
+FULL_FIDELITY_SUFFIX = ":full"
+FULL_FIDELITY = "full"
+
+
+def keep_full_fidelity(fidelity: Optional[str] = None) -> bool:
+    """Returns whether the unreduced shadows are stored as well, only when the job was started for a client that asked for them unless the deployment keeps them for every job"""
+    return (
+        fidelity == FULL_FIDELITY
+        or os.getenv("SHADOW_KEEP_FULL_FIDELITY", "0") == "1"
+    )
+
+
+def full_fidelity_key(redis_key) -> str:
+    if isinstance(redis_key, bytes):
+        redis_key = redis_key.decode("utf-8")
+    return redis_key + FULL_FIDELITY_SUFFIX
+
+
+class ShadowPrecision:
+    """Simplifies the dissolved shadows and snaps them to a grid before they are stored, a grid size and tolerance of 0 keep the full precision"""
+
+    def __init__(
+        self, grid_size: Optional[float] = None, tolerance: Optional[float] = None
+    ):
+        self.grid_size = (
+            grid_size
+            if grid_size is not None
+            else float(os.getenv("SHADOW_GRID_SIZE", 1e-6))
+        )
+        self.tolerance = (
+            tolerance
+            if tolerance is not None
+            else float(os.getenv("SHADOW_SIMPLIFY_TOLERANCE", 1e-6))
+        )
+
+    @property
+    def is_full_fidelity(self) -> bool:
+        return self.grid_size == 0 and self.tolerance == 0
+
+    def reduce(self, dissolved: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """Returns the shadows with the variant recorded in the properties of every feature"""
+        reduced = dissolved.copy()
+        if not self.is_full_fidelity and not reduced.empty:
+            geometries = reduced.geometry.to_numpy()
+            if self.tolerance > 0:
+                geometries = shapely.simplify(
+                    geometries, self.tolerance, preserve_topology=True
+                )
+            if self.grid_size > 0:
+                # Snapping keeps the output valid, the simplification alone can leave touching parts
+                geometries = shapely.set_precision(geometries, self.grid_size)
+            logger.info(
+                "Reduced shadows from %s to %s vertices"
+                % (
+                    str(shapely.get_num_coordinates(dissolved.geometry.to_numpy()).sum()),
+                    str(shapely.get_num_coordinates(geometries).sum()),
+                )
+            )
+            reduced = reduced.set_geometry(list(geometries), crs=dissolved.crs)
+        reduced["grid_size"] = self.grid_size
+        reduced["simplify_tolerance"] = self.tolerance
+        return reduced
+
+
+def reduce_shadow_precision(dissolved: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    return ShadowPrecision().reduce(dissolved)
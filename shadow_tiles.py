@@ -0,0 +1,237 @@
+import math
+import os
+import numpy as np
+import geopandas as gpd
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+from shadow_engine import (
+    PreparedBuildings,
+    PreparedTrees,
+    get_tree_shadow_mode,
+    split_trees,
+    SHADOW_COLUMNS,
+    TREE_CROWN_RADIUS,
+)
+from shadow_union import ShadowUnion
+from local_projection import LocalProjection
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+# Clipped shadows have vertices on the tile edges up to rounding, pieces closer than this reach the edge
+TILE_EDGE_TOLERANCE = 1e-9
+
+
+def get_default_tile_workers() -> int:
+    """Returns the number of processes used for tiled shadows, 0 or 1 keeps the computation in the job process"""
+    return int(os.getenv("SHADOW_TILE_WORKERS", 0))
+
+
+def compute_tile_shadows(
+    footprints_wkb: List[bytes],
+    heights: np.ndarray,
+    building_ids: np.ndarray,
+    crown_radii: np.ndarray,
+    canopy_wkb: List[bytes],
+    sun_position: dict,
+    tile_bounds: tuple,
+    tree_shadow_mode: str,
+) -> bytes:
+    """Computes and dissolves the shadows of the buildings and trees around a tile and clips them to the tile, runs in a worker process"""
+    pieces = list(shapely.from_wkb(canopy_wkb))
+    if len(footprints_wkb):
+        features = gpd.GeoDataFrame(
+            {
+                "height": heights,
+                "building_id": building_ids,
+                TREE_CROWN_RADIUS: crown_radii,
+            },
+            geometry=shapely.from_wkb(footprints_wkb),
+        )
+        buildings, trees = split_trees(features, tree_shadow_mode)
+        for prepared in [PreparedBuildings(buildings), PreparedTrees(trees)]:
+            if not prepared.is_empty:
+                pieces.extend(prepared.project_shadows(sun_position))
+    tile_shadow = shapely.intersection(
+        shapely.union_all(pieces), shapely.box(*tile_bounds)
+    )
+    return shapely.to_wkb(tile_shadow)
+
+
+class ShadowTiler:
+    """Splits the buildings into tiles with a halo as wide as the longest possible shadow so every tile can be computed on its own"""
+
+    def __init__(
+        self,
+        tile_size: float = None,
+        max_workers: int = None,
+        tree_shadow_mode: str = None,
+    ):
+        self.tile_size = (
+            tile_size if tile_size else float(os.getenv("SHADOW_TILE_SIZE", 1000))
+        )
+        self.max_workers = max_workers if max_workers else get_default_tile_workers()
+        self.tree_shadow_mode = (
+            tree_shadow_mode if tree_shadow_mode else get_tree_shadow_mode()
+        )
+
+    def get_halo_length(self, buildings: gpd.GeoDataFrame, sun_position: dict) -> float:
+        """Returns the longest shadow of the buildings in metres, tree crowns reach at most their radius beyond the shadow of their height"""
+        heights = buildings["height"].to_numpy(dtype=float)
+        heights = heights[heights > 0]
+        if not len(heights):
+            return 0
+        halo_length = heights.max() / math.tan(sun_position["altitude"])
+        if TREE_CROWN_RADIUS in buildings:
+            halo_length += float(buildings[TREE_CROWN_RADIUS].fillna(0).max())
+        return halo_length
+
+    def can_tile(self, buildings: gpd.GeoDataFrame, sun_position: dict) -> bool:
+        """Tiles pay off only when the halo is narrower than a tile, with the sun low every tile would project almost every building"""
+        return (
+            sun_position["altitude"] > 0
+            and self.get_halo_length(buildings, sun_position) <= self.tile_size
+        )
+
+    def get_tiles(
+        self, total_bounds: np.ndarray, projection: LocalProjection
+    ) -> List[tuple]:
+        xmin, ymin, xmax, ymax = total_bounds
+        tile_lon, tile_lat = projection.degree_spans(self.tile_size)
+        tiles = []
+        for tile_xmin in np.arange(xmin, xmax, tile_lon):
+            for tile_ymin in np.arange(ymin, ymax, tile_lat):
+                tiles.append(
+                    (
+                        tile_xmin,
+                        tile_ymin,
+                        min(tile_xmin + tile_lon, xmax),
+                        min(tile_ymin + tile_lat, ymax),
+                    )
+                )
+        return tiles
+
+    def compute_shadows(
+        self,
+        buildings: gpd.GeoDataFrame,
+        sun_position: dict,
+        canopy: Optional[gpd.GeoDataFrame] = None,
+    ) -> gpd.GeoDataFrame:
+        """Returns the dissolved building shadows and canopy in the same shape as GeoDataFrame.dissolve()"""
+        if sun_position["altitude"] < 0:
+            raise ValueError("Given time before sunrise or after sunset")
+        buildings = buildings[buildings["height"] > 0]
+        footprints = buildings.geometry.to_numpy()
+        canopy_geometries = (
+            canopy.geometry.to_numpy()
+            if canopy is not None
+            else np.array([], dtype=object)
+        )
+        all_geometries = np.concatenate([footprints, canopy_geometries])
+        if len(all_geometries) == 0:
+            return self.to_dissolved([], None)
+        # The bounds are padded so that tiles also cover the shadows falling outside the buildings
+        max_shadow_length = self.get_halo_length(buildings, sun_position)
+        total_bounds = shapely.total_bounds(all_geometries)
+        projection = LocalProjection.from_geometries(all_geometries)
+        halo_lon, halo_lat = projection.degree_spans(max_shadow_length)
+        padded_bounds = total_bounds + np.array(
+            [-halo_lon, -halo_lat, halo_lon, halo_lat]
+        )
+
+        footprints_tree = shapely.STRtree(footprints)
+        canopy_tree = shapely.STRtree(canopy_geometries)
+        heights = buildings["height"].to_numpy(dtype=float)
+        building_ids = buildings["building_id"].to_numpy()
+        crown_radii = (
+            buildings[TREE_CROWN_RADIUS].fillna(0).to_numpy(dtype=float)
+            if TREE_CROWN_RADIUS in buildings
+            else np.zeros(len(buildings))
+        )
+
+        tile_args = []
+        for tile_bounds in self.get_tiles(padded_bounds, projection):
+            tile_xmin, tile_ymin, tile_xmax, tile_ymax = tile_bounds
+            halo = shapely.box(
+                tile_xmin - halo_lon,
+                tile_ymin - halo_lat,
+                tile_xmax + halo_lon,
+                tile_ymax + halo_lat,
+            )
+            building_index = footprints_tree.query(halo)
+            canopy_index = canopy_tree.query(shapely.box(*tile_bounds))
+            if len(building_index) == 0 and len(canopy_index) == 0:
+                continue
+            tile_args.append(
+                (
+                    list(shapely.to_wkb(footprints[building_index])),
+                    heights[building_index],
+                    building_ids[building_index],
+                    crown_radii[building_index],
+                    list(shapely.to_wkb(canopy_geometries[canopy_index])),
+                    sun_position,
+                    tile_bounds,
+                    self.tree_shadow_mode,
+                )
+            )
+
+        logger.info(
+            "Computing shadows for %s tiles on %s processes"
+            % (str(len(tile_args)), str(self.max_workers))
+        )
+        if self.max_workers > 1:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                tile_shadows = list(
+                    executor.map(compute_tile_shadows, *zip(*tile_args))
+                )
+        else:
+            tile_shadows = [compute_tile_shadows(*args) for args in tile_args]
+
+        tile_pieces = self.stitch(tile_shadows, [args[6] for args in tile_args])
+        first_building_id = building_ids.min() if len(building_ids) else None
+        return self.to_dissolved(tile_pieces, first_building_id)
+
+    def stitch(self, tile_shadows: List[bytes], tiles: List[tuple]) -> np.ndarray:
+        """Unions the pieces of the tile shadows that reach a tile edge, the pieces inside a tile can not overlap another tile and are kept as they are"""
+        pieces = []
+        on_edge = []
+        for tile_shadow, tile_bounds in zip(tile_shadows, tiles):
+            parts = shapely.get_parts(shapely.from_wkb(tile_shadow))
+            # Clipping leaves lines and points where a shadow only grazes the tile
+            parts = parts[shapely.get_type_id(parts) == 3]
+            pieces.append(parts)
+            on_edge.append(
+                shapely.dwithin(
+                    parts,
+                    shapely.boundary(shapely.box(*tile_bounds)),
+                    TILE_EDGE_TOLERANCE,
+                )
+            )
+        if not pieces:
+            return np.array([], dtype=object)
+        pieces = np.concatenate(pieces)
+        on_edge = np.concatenate(on_edge)
+        logger.info(
+            "Stitching %s of %s tile pieces along the tile edges"
+            % (str(on_edge.sum()), str(len(pieces)))
+        )
+        stitched = (
+            ShadowUnion().union_clusters(pieces[on_edge])
+            if on_edge.any()
+            else np.array([], dtype=object)
+        )
+        return np.concatenate([pieces[~on_edge], shapely.get_parts(stitched)])
+
+    def to_dissolved(self, pieces: np.ndarray, building_id) -> gpd.GeoDataFrame:
+        """Collects the disjoint pieces into one row with the columns ShadowUnion.dissolve() keeps for building shadows"""
+        columns = [c for c in SHADOW_COLUMNS if c != "geometry"]
+        if not len(pieces):
+            return gpd.GeoDataFrame(
+                columns=columns + ["geometry"], geometry="geometry", crs="EPSG:4326"
+            )
+        return gpd.GeoDataFrame(
+            {"building_id": [building_id], "height": [0], "type": ["ground"]},
+            geometry=[shapely.multipolygons(pieces)],
+            crs="EPSG:4326",
+        )[columns + ["geometry"]]
@@ -0,0 +1,112 @@
+import os
+import time
+import numpy as np
+import geopandas as gpd
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from typing import Optional
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+COMPONENTS_UNION = "components"
+DISSOLVE_UNION = "dissolve"
+UNION_METHODS = [COMPONENTS_UNION, DISSOLVE_UNION]
+
+
+def get_default_union_method() -> str:
+    """Returns the union method configured for this deployment"""
+    method = os.getenv("SHADOW_UNION_METHOD", COMPONENTS_UNION)
+    if method not in UNION_METHODS:
+        logger.error("Unknown shadow union method %s, using %s" % (method, COMPONENTS_UNION))
+        method = COMPONENTS_UNION
+    return method
+
+
+class ShadowUnion:
+    """Unions overlapping shadows per connected cluster instead of in one global union.
+
+    Shadows only interact with the shadows they touch, so the geometries are grouped into clusters of intersecting
+    geometries with an STRtree and every cluster is unioned on its own. Clusters never overlap each other, they can be
+    returned as separate features or collected into one MultiPolygon without another overlay.
+    """
+
+    def __init__(self, method: Optional[str] = None):
+        self.method = method if method else get_default_union_method()
+        self.timings = {}
+
+    def get_clusters(self, geometries: np.ndarray) -> np.ndarray:
+        """Returns a cluster label for every geometry, geometries sharing a label intersect directly or through others"""
+        tree = shapely.STRtree(geometries)
+        pairs = tree.query(geometries, predicate="intersects")
+        adjacency = coo_matrix(
+            (np.ones(pairs.shape[1], dtype=bool), (pairs[0], pairs[1])),
+            shape=(len(geometries), len(geometries)),
+        )
+        _, labels = connected_components(adjacency, directed=False)
+        return labels
+
+    def union_clusters(self, geometries: np.ndarray) -> np.ndarray:
+        """Returns one geometry per cluster, single geometries are passed through without an overlay"""
+        start = time.perf_counter()
+        labels = self.get_clusters(geometries)
+        self.timings["clusters"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        order = np.argsort(labels, kind="stable")
+        cluster_starts = np.flatnonzero(np.diff(labels[order])) + 1
+        clusters = []
+        for cluster in np.split(geometries[order], cluster_starts):
+            clusters.append(cluster[0] if len(cluster) == 1 else shapely.union_all(cluster))
+        self.timings["unions"] = time.perf_counter() - start
+        return np.array(clusters, dtype=object)
+
+    def dissolve(
+        self, shadows: gpd.GeoDataFrame, partitioned: bool = False
+    ) -> gpd.GeoDataFrame:
+        """Returns the union of the shadows in the same shape as GeoDataFrame.dissolve(), one row per cluster when partitioned"""
+        start = time.perf_counter()
+        self.timings = {}
+        geometries = shadows.geometry.to_numpy()
+        geometries = geometries[
+            ~(shapely.is_missing(geometries) | shapely.is_empty(geometries))
+        ]
+        if self.method == DISSOLVE_UNION or len(geometries) == 0:
+            dissolved = shadows.dissolve()
+        else:
+            clusters = self.union_clusters(geometries)
+            if not partitioned:
+                parts = shapely.get_parts(clusters)
+                if (shapely.get_type_id(parts) == 3).all():
+                    # Clusters are disjoint so their polygons form a valid MultiPolygon as they are
+                    clusters = [shapely.multipolygons(parts)]
+                else:
+                    clusters = [shapely.union_all(clusters)]
+            # The attributes of the first row are kept like dissolve(aggfunc="first")
+            attributes = shadows.drop(columns=shadows.geometry.name).iloc[[0]]
+            dissolved = gpd.GeoDataFrame(
+                attributes.loc[attributes.index.repeat(len(clusters))].reset_index(
+                    drop=True
+                ),
+                geometry=list(clusters),
+                crs=shadows.crs,
+            )
+        self.timings["total"] = time.perf_counter() - start
+        logger.info(
+            "Dissolved %s shadows into %s features with %s in %.2fs %s"
+            % (
+                str(len(shadows)),
+                str(len(dissolved)),
+                self.method,
+                self.timings["total"],
+                str({k: round(v, 3) for k, v in self.timings.items()}),
+            )
+        )
+        return dissolved
+
+
+def dissolve_shadows(
+    shadows: gpd.GeoDataFrame, partitioned: bool = False, method: Optional[str] = None
+) -> gpd.GeoDataFrame:
+    return ShadowUnion(method=method).dissolve(shadows, partitioned=partitioned)
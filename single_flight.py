@@ -0,0 +1,107 @@
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from conn import get_redis
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+# A population that takes longer than this is taken over by a waiting job
+LAYER_LOCK_TTL = int(os.getenv("LAYER_LOCK_TTL", 600))
+LAYER_WAIT_POLL_SECONDS = 5
+# Downloads are deferred behind the job populating the key when they are enqueued, a job only waits in a worker when
+# it was enqueued in the moment before the key was claimed, it fails well before the default RQ job timeout of 180 seconds
+LAYER_WAIT_TIMEOUT = int(os.getenv("LAYER_WAIT_TIMEOUT", 120))
+
+
+class LayerWaitTimeout(TimeoutError):
+    pass
+
+# The lock is only released by the job holding it
+_release_lock = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def lock_key(storage_key: str) -> str:
+    return storage_key + ":lock"
+
+
+def ready_channel(storage_key: str) -> str:
+    return storage_key + ":ready"
+
+
+def claim_key(storage_key: str) -> str:
+    return storage_key + ":claim"
+
+
+def claim_population(
+    storage_key: str, job_id: str, ttl: int = LAYER_LOCK_TTL
+) -> Optional[str]:
+    """Claims the population of the key for a job that is about to be enqueued, returns the id of the job that claimed it before or None"""
+    if r.set(claim_key(storage_key), job_id, nx=True, ex=ttl):
+        return None
+    holder_id = r.get(claim_key(storage_key))
+    if holder_id is None:
+        # The claim expired in between, the next enqueue claims it again
+        return None
+    return holder_id.decode("utf-8")
+
+
+def take_over_population(storage_key: str, job_id: str, ttl: int = LAYER_LOCK_TTL):
+    """Replaces the claim of a job that is no longer queued or running"""
+    r.set(claim_key(storage_key), job_id, ex=ttl)
+
+
+@contextmanager
+def single_flight(
+    storage_key: str,
+    lock_ttl: int = LAYER_LOCK_TTL,
+    wait_timeout: int = LAYER_WAIT_TIMEOUT,
+) -> Iterator[bool]:
+    """Yields True to the one job that should populate the key and False to the others once it is populated.
+
+    Waiting jobs subscribe to the completion signal of the key before they check it, so a signal is never missed.
+    If the populating job fails the others are woken up and one of them takes over, a job that waited longer than
+    wait_timeout fails with LayerWaitTimeout instead of populating the key next to the job holding the lock.
+    """
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + wait_timeout
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(ready_channel(storage_key))
+    try:
+        while True:
+            if r.exists(storage_key):
+                populate = False
+                break
+            if r.set(lock_key(storage_key), token, nx=True, ex=lock_ttl):
+                # The key may have been populated between the check and the lock
+                populate = not r.exists(storage_key)
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LayerWaitTimeout(
+                    "Waited %s seconds for another job to populate %s"
+                    % (str(wait_timeout), storage_key)
+                )
+            logger.info("Waiting for another job to populate %s" % storage_key)
+            pubsub.get_message(timeout=min(LAYER_WAIT_POLL_SECONDS, remaining))
+    finally:
+        pubsub.close()
+
+    if not populate:
+        r.eval(_release_lock, 1, lock_key(storage_key), token)
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        r.eval(_release_lock, 1, lock_key(storage_key), token)
+        r.publish(ready_channel(storage_key), token)
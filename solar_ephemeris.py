@@ -0,0 +1,84 @@
+import json
+import pandas as pd
+from suncalc import get_position
+from typing import Dict, List
+from conn import get_redis
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+# Two decimals is about a kilometre, the sun position does not change measurably within it
+CENTER_PRECISION = 2
+SUN_POSITION_CACHE_TTL = 2592000
+MAX_MEMOIZED_POSITIONS = 100000
+
+_memoized_sun_positions: Dict[str, dict] = {}
+
+
+def to_utc(date_time) -> pd.Timestamp:
+    date_time = pd.Timestamp(date_time)
+    if date_time.tzinfo is None:
+        return date_time.tz_localize("UTC")
+    return date_time.tz_convert("UTC")
+
+
+class SolarEphemeris:
+    """Sun positions for a project keyed on its rounded center, computed vectorized and memoized in process and in Redis"""
+
+    def __init__(self, center_lon: float, center_lat: float):
+        self.center_lon = round(center_lon, CENTER_PRECISION)
+        self.center_lat = round(center_lat, CENTER_PRECISION)
+
+    @classmethod
+    def from_bounds(cls, bounds: str):
+        xmin, ymin, xmax, ymax = [float(b) for b in bounds.split(",")]
+        return cls(center_lon=(xmin + xmax) / 2, center_lat=(ymin + ymax) / 2)
+
+    def cache_key(self, date_time: pd.Timestamp) -> str:
+        return "sun_position:{lon:.{p}f},{lat:.{p}f}:{date_time}".format(
+            lon=self.center_lon,
+            lat=self.center_lat,
+            p=CENTER_PRECISION,
+            date_time=date_time.strftime("%Y-%m-%dT%H:%M:%S"),
+        )
+
+    def get_positions(self, date_times: List[pd.Timestamp]) -> List[dict]:
+        """Returns the sun azimuth and altitude for every time, only the times not seen before are computed"""
+        date_times = [to_utc(d) for d in date_times]
+        cache_keys = [self.cache_key(d) for d in date_times]
+        positions = [_memoized_sun_positions.get(k) for k in cache_keys]
+
+        missing = [i for i, p in enumerate(positions) if p is None]
+        if missing:
+            stored_positions = r.mget([cache_keys[i] for i in missing])
+            for i, stored_position in zip(missing, stored_positions):
+                if stored_position is not None:
+                    positions[i] = json.loads(stored_position)
+            missing = [i for i in missing if positions[i] is None]
+
+        if missing:
+            computed = get_position(
+                pd.DatetimeIndex([date_times[i] for i in missing]),
+                self.center_lon,
+                self.center_lat,
+            )
+            pipe = r.pipeline()
+            for i, azimuth, altitude in zip(
+                missing, computed["azimuth"], computed["altitude"]
+            ):
+                positions[i] = {"azimuth": float(azimuth), "altitude": float(altitude)}
+                pipe.set(
+                    cache_keys[i], json.dumps(positions[i]), ex=SUN_POSITION_CACHE_TTL
+                )
+            pipe.execute()
+            logger.info("Computed %s sun positions" % str(len(missing)))
+
+        if len(_memoized_sun_positions) > MAX_MEMOIZED_POSITIONS:
+            _memoized_sun_positions.clear()
+        _memoized_sun_positions.update(zip(cache_keys, positions))
+        return positions
+
+    def get_position(self, date_time: pd.Timestamp) -> dict:
+        return self.get_positions([date_time])[0]
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import requests
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+SOURCE_CACHE_DIR = os.getenv(
+    "SOURCE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "gdh-source-cache")
+)
+SOURCE_CHUNK_BYTES = 64 * 1024
+
+
+class SourceBody:
+    """The chunks of a source body with the validators it was served with, not_modified is set when it is read from disk"""
+
+    def __init__(self, chunks: Iterator[bytes], validators: dict, not_modified: bool):
+        self.chunks = chunks
+        self.validators = validators
+        self.not_modified = not_modified
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.chunks
+
+
+class SourceCache:
+    """Keeps the last body of every remote layer on disk with its ETag and Last-Modified and revalidates it with conditional requests.
+
+    Every entry is one file, a JSON line with the validators followed by the body, so it is replaced atomically.
+    """
+
+    def __init__(
+        self, directory: str = SOURCE_CACHE_DIR, session: requests.Session = None
+    ):
+        self.directory = directory
+        self.session = session if session else requests.Session()
+
+    def entry_path(self, url: str) -> str:
+        return os.path.join(
+            self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".source"
+        )
+
+    def read_validators(self, url: str) -> Optional[dict]:
+        try:
+            with open(self.entry_path(url), "rb") as entry:
+                return json.loads(entry.readline())
+        except (OSError, ValueError):
+            return None
+
+    def _cached_chunks(self, entry) -> Iterator[bytes]:
+        return iter(lambda: entry.read(SOURCE_CHUNK_BYTES), b"")
+
+    def _store_chunks(
+        self, url: str, response: requests.Response, validators: dict
+    ) -> Iterator[bytes]:
+        """Yields the body while writing it to a new entry, the entry replaces the old one only once the body is complete"""
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=self.directory, suffix=".partial", delete=False
+        ) as entry:
+            try:
+                entry.write(json.dumps(validators).encode("utf-8") + b"\n")
+                for chunk in response.iter_content(chunk_size=SOURCE_CHUNK_BYTES):
+                    entry.write(chunk)
+                    yield chunk
+            except BaseException:
+                entry.close()
+                os.unlink(entry.name)
+                raise
+        if validators["etag"] is None and validators["last_modified"] is None:
+            # Without validators the body can not be revalidated, keeping it would only serve stale data
+            os.unlink(entry.name)
+            return
+        os.replace(entry.name, self.entry_path(url))
+
+    @contextmanager
+    def open(self, url: str) -> Iterator[Optional[SourceBody]]:
+        """Yields the chunks of the body of the url, read from disk when the upstream answers 304 Not Modified, or None if it could not be downloaded"""
+        validators = self.read_validators(url)
+        headers = {}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        with self.session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 304 and validators:
+                try:
+                    entry = open(self.entry_path(url), "rb")
+                except OSError:
+                    entry = None
+                if entry is not None:
+                    logger.info("Source %s is not modified, reading it from disk" % url)
+                    with entry:
+                        entry.readline()
+                        yield SourceBody(
+                            self._cached_chunks(entry), validators, not_modified=True
+                        )
+                    return
+                # The entry was removed after it was revalidated, download the layer again
+                with self.session.get(url, stream=True) as full_response:
+                    yield from self._yield_response(url, full_response)
+                return
+            yield from self._yield_response(url, response)
+
+    def _yield_response(self, url: str, response: requests.Response):
+        body_chunks = self._response_chunks(url, response)
+        yield body_chunks
+        if body_chunks is not None:
+            # Readers stop at the end of the layer, what follows it still belongs to the entry
+            for _ in body_chunks:
+                pass
+
+    def _response_chunks(
+        self, url: str, response: requests.Response
+    ) -> Optional[SourceBody]:
+        if response.status_code != 200:
+            return None
+        validators = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        return SourceBody(
+            self._store_chunks(url, response, validators),
+            validators,
+            not_modified=False,
+        )
+
+
+source_cache = SourceCache()
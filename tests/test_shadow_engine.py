@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pybdshadow
+import pytest
+from shapely.geometry import Polygon
+from suncalc import get_position
+from shadow_engine import (
+    PYBDSHADOW_ENGINE,
+    VECTORIZED_ENGINE,
+    compute_building_shadows,
+    compute_building_shadows_series,
+)
+
+# The engines project the same footprints, they only differ by floating point error
+MAX_RELATIVE_SYMMETRIC_DIFFERENCE = 1e-4
+
+
+def make_buildings(count: int = 300) -> gpd.GeoDataFrame:
+    """Rotated boxes and L shaped footprints of random heights, the shapes buildings in the project areas have"""
+    rng = np.random.default_rng(0)
+    footprints = []
+    for index in range(count):
+        x = 34.77 + rng.random() * 0.02
+        y = 32.07 + rng.random() * 0.02
+        width = rng.random() * 0.0003 + 0.00005
+        depth = rng.random() * 0.0003 + 0.00005
+        if index % 3 == 0:
+            footprint = Polygon(
+                [
+                    (x, y),
+                    (x + width, y),
+                    (x + width, y + depth / 2),
+                    (x + width / 2, y + depth / 2),
+                    (x + width / 2, y + depth),
+                    (x, y + depth),
+                ]
+            )
+        else:
+            footprint = shapely.affinity.rotate(
+                shapely.box(x, y, x + width, y + depth), rng.random() * 90
+            )
+        footprints.append(footprint)
+    return gpd.GeoDataFrame(
+        {
+            "height": rng.random(count) * 40 + 3,
+            "building_id": ["building-%s" % index for index in range(count)],
+        },
+        geometry=footprints,
+        crs="EPSG:4326",
+    )
+
+
+def assert_same_shadows(expected: gpd.GeoDataFrame, shadows: gpd.GeoDataFrame):
+    assert list(shadows.columns) == list(expected.columns)
+    assert list(shadows["building_id"]) == list(expected["building_id"])
+    expected_geometries = expected.geometry.values
+    symmetric_difference = shapely.area(
+        shapely.symmetric_difference(expected_geometries, shadows.geometry.values)
+    )
+    relative_difference = symmetric_difference / shapely.area(expected_geometries)
+    assert relative_difference.max() < MAX_RELATIVE_SYMMETRIC_DIFFERENCE
+
+
+def test_vectorized_engine_matches_pybdshadow(monkeypatch):
+    monkeypatch.setenv("TREE_SHADOW_MODE", "analytic")
+    buildings = make_buildings()
+    date_time = pd.to_datetime("2024-08-06T10:10:00").tz_localize("UTC")
+
+    expected = pybdshadow.bdshadow_sunlight(buildings, date_time)
+    assert_same_shadows(
+        expected,
+        compute_building_shadows(buildings, date_time, engine=VECTORIZED_ENGINE),
+    )
+    assert_same_shadows(
+        expected,
+        compute_building_shadows(buildings, date_time, engine=PYBDSHADOW_ENGINE),
+    )
+
+
+def test_vectorized_engine_matches_pybdshadow_for_a_given_sun_position():
+    buildings = make_buildings()
+    date_time = pd.to_datetime("2024-12-21T11:30:00").tz_localize("UTC")
+    # pybdshadow takes the sun position at the mean of the bounds of the buildings
+    lon1, lat1, lon2, lat2 = buildings.bounds.mean()
+    sun_position = get_position(date_time, (lon1 + lon2) / 2, (lat1 + lat2) / 2)
+
+    assert_same_shadows(
+        pybdshadow.bdshadow_sunlight(buildings, date_time),
+        compute_building_shadows(
+            buildings, date_time, engine=VECTORIZED_ENGINE, sun_position=sun_position
+        ),
+    )
+
+
+def test_unknown_engine_is_an_error():
+    date_time = pd.to_datetime("2024-08-06T10:10:00").tz_localize("UTC")
+    with pytest.raises(ValueError):
+        compute_building_shadows(make_buildings(10), date_time, engine="raytraced")
+    with pytest.raises(ValueError):
+        list(
+            compute_building_shadows_series(
+                make_buildings(10), [date_time], engine="raytraced"
+            )
+        )
+
+
+def test_series_of_trees_only(monkeypatch):
+    monkeypatch.setenv("TREE_SHADOW_MODE", "analytic")
+    trees = make_buildings(10)
+    trees["tree_crown_radius"] = 3.0
+    date_times = [
+        pd.to_datetime("2024-08-06T08:00:00").tz_localize("UTC"),
+        pd.to_datetime("2024-08-06T12:00:00").tz_localize("UTC"),
+    ]
+
+    series = list(
+        compute_building_shadows_series(trees, date_times, engine=VECTORIZED_ENGINE)
+    )
+
+    assert [date_time for date_time, _ in series] == date_times
+    assert all(len(shadows) == len(trees) for _, shadows in series)
@@ -0,0 +1,84 @@
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from source_cache import SourceCache
+
+
+class LayerHandler(BaseHTTPRequestHandler):
+    """Serves the current body of the server with an ETag and Last-Modified and answers conditional requests with 304"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        etag = '"%s"' % hashlib.sha1(server.body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            server.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(server.body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", server.last_modified)
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def layer_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LayerHandler)
+    server.body = b'{"type": "FeatureCollection", "features": []}'
+    server.last_modified = formatdate(usegmt=True)
+    server.requests = []
+    server.not_modified = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_body(cache: SourceCache, url: str):
+    with cache.open(url) as source_body:
+        assert source_body is not None
+        return b"".join(source_body), source_body.not_modified
+
+
+def test_source_cache_revalidates_and_refetches(layer_server, tmp_path):
+    url = "http://127.0.0.1:%s/layer.geojson" % layer_server.server_address[1]
+    cache = SourceCache(directory=str(tmp_path))
+    first_body = layer_server.body
+
+    body, not_modified = read_body(cache, url)
+    assert body == first_body
+    assert not not_modified
+    assert "If-None-Match" not in layer_server.requests[-1]
+    validators = cache.read_validators(url)
+    assert validators["etag"] and validators["last_modified"]
+
+    # The upstream answers 304 and the body is read from disk
+    body, not_modified = read_body(cache, url)
+    assert body == first_body
+    assert not_modified
+    assert layer_server.not_modified == 1
+    assert layer_server.requests[-1]["If-None-Match"] == validators["etag"]
+    assert layer_server.requests[-1]["If-Modified-Since"] == validators["last_modified"]
+
+    # A changed layer is downloaded again and replaces the entry
+    layer_server.body = b'{"type": "FeatureCollection", "features": [null]}'
+    body, not_modified = read_body(cache, url)
+    assert body == layer_server.body
+    assert not not_modified
+    assert layer_server.not_modified == 1
+    assert cache.read_validators(url)["etag"] != validators["etag"]
+
+    body, not_modified = read_body(cache, url)
+    assert body == layer_server.body
+    assert not_modified
@@ -0,0 +1,46 @@
+import math
+import geopandas as gpd
+import shapely
+import mapbox_vector_tile
+import pytest
+import job_results
+import vector_tiles
+from geometry_store import encode_layer
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake_redis = fakeredis.FakeRedis()
+    monkeypatch.setattr(vector_tiles, "r", fake_redis)
+    monkeypatch.setattr(job_results, "r", fake_redis)
+    vector_tiles._parsed_layers.clear()
+    return fake_redis
+
+
+def tile_of(lon: float, lat: float, z: int) -> tuple:
+    n = 2**z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+
+def test_tile_of_a_layer_without_properties(redis):
+    canopy = gpd.GeoDataFrame(
+        geometry=shapely.buffer(
+            shapely.points([34.7701, 34.7703], [32.0701, 32.0702]), 0.00005
+        ),
+        crs="EPSG:4326",
+    )
+    redis.set("bounds:trees", encode_layer(canopy))
+    redis.set("session:trees", "bounds:trees")
+
+    x, y = tile_of(34.7702, 32.0701, 16)
+    tile = vector_tiles.get_vector_tile(
+        vector_tiles.TREES_LAYER, "session:trees", 16, x, y
+    )
+
+    features = mapbox_vector_tile.decode(tile)[vector_tiles.TREES_LAYER]["features"]
+    assert len(features) == 2
+    assert all(feature["properties"] == {} for feature in features)
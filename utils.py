@@ -1,26 +1,65 @@
 import arrow
-import time
 import pandas as pd
 from data_definitions import (
     GeodesignhubDataShadowGenerationRequest,
     RoadsDownloadRequest,
     RoadsShadowOverlap,
+    RoadsShadowSeries,
     ShadowsRoadsIntersectionRequest,
     TreesDownloadRequest,
     RoadsShadowsComputationStartRequest,
     BuildingsDownloadRequest,
     ExistingBuildingsDataShadowGenerationRequest,
+    BaselineShadowGenerationRequest,
     ExistingBuildingsFeatureProperties,
     DrawnTreesShadowGenerationRequest,
     ErrorResponse,
     DrawnTreesFeatureProperties,
+    GeodesignhubShadowSweepRequest,
 )
 from typing import Union
 import geojson
 from dacite import from_dict
-from pyproj import Geod
 import geopandas as gpd
-import pybdshadow
+from shadow_engine import (
+    compute_building_shadows,
+    compute_building_shadows_series,
+    get_default_tree_crown_radius,
+    resolve_shadow_engine,
+    PYBDSHADOW_ENGINE,
+)
+from shadow_hours import ShadowHoursGrid
+from solar_ephemeris import SolarEphemeris
+from shadow_tiles import ShadowTiler, get_default_tile_workers
+from shadow_union import dissolve_shadows
+from local_projection import LocalProjection
+from road_index import build_road_index, get_road_index
+from road_shade import segment_shade_key, encode_segment_shade
+from layer_ingest import download_layer
+from city_layers import extract_city_layer
+from single_flight import single_flight
+from value_codec import encode_value
+from job_results import commit_result, bump_result_version
+from baseline_shadows import (
+    baseline_shadow_key,
+    baseline_index_key,
+    BASELINE_SHADOW_TTL,
+)
+from geometry_store import (
+    encode_layer,
+    empty_layer,
+    load_layer,
+)
+from shadow_precision import (
+    reduce_shadow_precision,
+    keep_full_fidelity,
+    full_fidelity_key,
+)
+from shadow_cache import (
+    compute_incremental_building_shadows,
+    shadow_result_key,
+    SHADOW_RESULT_CACHE_TTL,
+)
 from shapely.geometry import Polygon, LineString, MultiLineString
 from shapely.geometry import shape
 from shapely.geometry.polygon import Polygon
@@ -28,11 +67,11 @@ from shapely.geometry.polygon import orient
 import json
 import uuid
 from typing import List
-import requests
 import numpy as np
 from dataclasses import asdict
 from conn import get_redis
 from shapely import STRtree
+import shapely
 import os
 import hashlib
 from geojson import Feature, FeatureCollection, Polygon, LineString, Point
@@ -70,7 +109,11 @@ class DrawnTreesProcessor:
             _geometry = Polygon(coordinates=_buffered_tree_feature["geometry"]["coordinates"])
             # We must use Building_id in the properties
             _feature_property = DrawnTreesFeatureProperties(
-                height=10, base_height=0, color="#FF0000", building_id=str(uuid.uuid4())
+                height=10,
+                base_height=0,
+                color="#FF0000",
+                building_id=str(uuid.uuid4()),
+                tree_crown_radius=get_default_tree_crown_radius(),
             )
             _feature = Feature(geometry=_geometry, properties=asdict(_feature_property))
             _all_features.append(_feature)
@@ -96,36 +139,37 @@ def download_roads(roads_download_request: RoadsDownloadRequest):
     bounds_hash = hashlib.sha512(bounds.encode("utf-8")).hexdigest()
 
     """A function to download roads GeoJSON from GDH data server for the given bounds,  """
-    fc = {"type": "FeatureCollection", "features": []}
     roads_storage_key = bounds_hash[:15] + ":roads"
-    r.set(session_roads_key, roads_storage_key)
-    r.expire(session_roads_key, time=6000)
-
-    if r.exists(roads_storage_key):
-        fc_str = r.get(roads_storage_key)
-        fc = json.loads(fc_str)
 
-    else:
-        bounds_filtering = os.getenv("USE_BOUNDS_FILTERING", None)
-        if bounds_filtering:
-            # If bounds filtering is enabled, the bounds parameter in the URL is replaced with the current bounds
-            r_url = roads_url.replace("__bounds__", bounds)
+    # Sessions opening the same bounds at once wait for one download instead of all downloading it
+    with single_flight(roads_storage_key) as populate:
+        if not populate:
+            logger.info("Reusing stored roads for the bounds")
         else:
-            r_url = roads_url
-        download_request = requests.get(r_url)
-        if download_request.status_code == 200:
-            fc = download_request.json()
-            r.set(roads_storage_key, json.dumps(fc))
-        else:
-            logger.error("Error in setting downloaded roads to local memory")
-            r.set(
-                roads_storage_key,
-                json.dumps({"type": "FeatureCollection", "features": []}),
-            )
-
-        r.expire(roads_storage_key, time=60000)
-
-    return fc
+            bounds_filtering = os.getenv("USE_BOUNDS_FILTERING", None)
+            if bounds_filtering:
+                # If bounds filtering is enabled, the bounds parameter in the URL is replaced with the current bounds
+                r_url = roads_url.replace("__bounds__", bounds)
+                stored = download_layer(r_url, roads_storage_key, ttl=60000)
+            else:
+                # The city layer is ingested once, the features of the bounds are extracted from it
+                stored = extract_city_layer(roads_url, bounds, roads_storage_key, ttl=60000)
+            if not stored:
+                logger.error("Error in setting downloaded roads to local memory")
+                r.set(roads_storage_key, encode_layer(empty_layer()))
+
+            # Tiles and parsed copies of the layer are keyed on its version
+            with commit_result(roads_storage_key, ttl=60000) as pipe:
+                pipe.expire(roads_storage_key, time=60000)
+            # Overlap jobs only process the shadows, the roads are projected and indexed once per download
+            build_road_index(roads_storage_key)
+
+    # The session points to the layer only once it is stored
+    with commit_result(session_roads_key, ttl=6000) as pipe:
+        pipe.set(session_roads_key, roads_storage_key, ex=6000)
+
+    # The layer is read from its storage key, returning it would store another copy as the job result
+    return roads_storage_key
 
 
 def download_trees(trees_download_request: TreesDownloadRequest):
@@ -144,36 +188,48 @@ def download_trees(trees_download_request: TreesDownloadRequest):
     bounds_hash = hashlib.sha512(bounds.encode("utf-8")).hexdigest()
 
     """A function to download roads GeoJSON from GDH data server for the given bounds,  """
-    fc = {"type": "FeatureCollection", "features": []}
     trees_storage_key = bounds_hash[:15] + ":trees"
 
-    r.set(session_trees_key, trees_storage_key)
-    r.expire(session_trees_key, time=6000)
-
-    if r.exists(trees_storage_key):
-        fc_str = r.get(trees_storage_key)
-        fc = json.loads(fc_str)
-    else:
-        bounds_filtering = os.getenv("USE_BOUNDS_FILTERING", None)
-        if bounds_filtering:
-            # If bounds filtering is enabled, the bounds parameter in the URL is replaced with the current bounds
-            t_url = trees_url.replace("__bounds__", bounds)
-        else:
-            t_url = trees_url
-
-        download_request = requests.get(t_url)
-        if download_request.status_code == 200:
-            fc = download_request.json()
-            r.set(trees_storage_key, json.dumps(fc))
+    # Sessions opening the same bounds at once wait for one download instead of all downloading it
+    with single_flight(trees_storage_key) as populate:
+        if not populate:
+            logger.info("Reusing stored trees for the bounds")
         else:
-            logger.error("Error")
-            r.set(
-                trees_storage_key,
-                json.dumps({"type": "FeatureCollection", "features": []}),
+            bounds_filtering = os.getenv("USE_BOUNDS_FILTERING", None)
+            if bounds_filtering:
+                # If bounds filtering is enabled, the bounds parameter in the URL is replaced with the current bounds
+                t_url = trees_url.replace("__bounds__", bounds)
+                stored = download_layer(t_url, trees_storage_key, ttl=60000)
+            else:
+                # The city layer is ingested once, the features of the bounds are extracted from it
+                stored = extract_city_layer(trees_url, bounds, trees_storage_key, ttl=60000)
+            if not stored:
+                logger.error("Error")
+                r.set(trees_storage_key, encode_layer(empty_layer()))
+            # Tiles and parsed copies of the layer are keyed on its version
+            with commit_result(trees_storage_key, ttl=60000) as pipe:
+                pipe.expire(trees_storage_key, time=60000)
+
+    # The session points to the layer only once it is stored
+    with commit_result(session_trees_key, ttl=6000) as pipe:
+        pipe.set(session_trees_key, trees_storage_key, ex=6000)
+
+    # The layer is read from its storage key, returning it would store another copy as the job result
+    return trees_storage_key
+
+
+def normalize_existing_buildings_properties(properties: List[dict]) -> List[dict]:
+    """Keeps only the height of the existing buildings, every building gets a new id"""
+    return [
+        asdict(
+            ExistingBuildingsFeatureProperties(
+                height=_f_prop["max_height"],
+                base_height=0,
+                building_id=str(uuid.uuid4()),
             )
-        r.expire(trees_storage_key, time=60000)
-
-    return fc
+        )
+        for _f_prop in properties
+    ]
 
 
 def download_existing_buildings(buildings_download_request: BuildingsDownloadRequest):
@@ -192,93 +248,89 @@ def download_existing_buildings(buildings_download_request: BuildingsDownloadReq
     bounds_hash = hashlib.sha512(bounds.encode("utf-8")).hexdigest()
 
     """A function to download roads GeoJSON from GDH data server for the given bounds,  """
-    fc = {"type": "FeatureCollection", "features": []}
     buildings_storage_key = bounds_hash[:15] + ":existing_buildings"
 
-    r.set(session_existing_buildings_key, buildings_storage_key)
-    r.expire(session_existing_buildings_key, time=6000)
-
-    if r.exists(buildings_storage_key):
-        fc_str = r.get(buildings_storage_key)
-        fc = json.loads(fc_str)
-    else:
-        bounds_filtering = os.getenv("USE_BOUNDS_FILTERING", None)
-        if bounds_filtering:
-            # If bounds filtering is enabled, the bounds parameter in the URL is replaced with the current bounds
-            b_url = _buildings_url.replace("__bounds__", bounds)
+    # Sessions opening the same bounds at once wait for one download instead of all downloading it
+    with single_flight(buildings_storage_key) as populate:
+        if not populate:
+            logger.info("Reusing stored existing buildings for the bounds")
         else:
-            b_url = _buildings_url
-
-        download_request = requests.get(b_url)
-        if download_request.status_code == 200:
-            fc = {"type": "FeatureCollection", "features": []}
-            raw_fc = download_request.json()
-            # Check the FC
-            for f in raw_fc["features"]:
-                _f_prop = f["properties"]
-                new_prop = ExistingBuildingsFeatureProperties(
-                    height=_f_prop["max_height"],
-                    base_height=0,
-                    building_id=str(uuid.uuid4()),
+            bounds_filtering = os.getenv("USE_BOUNDS_FILTERING", None)
+            if bounds_filtering:
+                # If bounds filtering is enabled, the bounds parameter in the URL is replaced with the current bounds
+                b_url = _buildings_url.replace("__bounds__", bounds)
+                stored = download_layer(
+                    b_url,
+                    buildings_storage_key,
+                    ttl=60000,
+                    normalize_properties=normalize_existing_buildings_properties,
+                )
+            else:
+                # The city layer is ingested once, the buildings of the bounds are extracted from it
+                stored = extract_city_layer(
+                    _buildings_url,
+                    bounds,
+                    buildings_storage_key,
+                    ttl=60000,
+                    normalize_properties=normalize_existing_buildings_properties,
                 )
-                f["properties"] = asdict(new_prop)
-                fc["features"].append(f)
+            if not stored:
+                logger.error("Error")
+                r.set(buildings_storage_key, encode_layer(empty_layer()))
+            # Tiles and parsed copies of the layer are keyed on its version
+            with commit_result(buildings_storage_key, ttl=60000) as pipe:
+                pipe.expire(buildings_storage_key, time=60000)
 
-            r.set(buildings_storage_key, json.dumps(fc))
-        else:
-            logger.error("Error")
-            r.set(
-                buildings_storage_key,
-                json.dumps({"type": "FeatureCollection", "features": []}),
-            )
-        r.expire(buildings_storage_key, time=60000)
+    # The session points to the layer only once it is stored
+    with commit_result(session_existing_buildings_key, ttl=6000) as pipe:
+        pipe.set(session_existing_buildings_key, buildings_storage_key, ex=6000)
 
-    return fc
+    # The layer is read from its storage key, returning it would store another copy as the job result
+    return buildings_storage_key
 
 
 class GeometryHelper:
 
     def buffer_tree_points(self, drawn_tree_geojson_features):
         df = gpd.GeoDataFrame.from_features(drawn_tree_geojson_features)
-        df["geometry"] = df["geometry"].buffer(0.00005)
+        # The crowns are drawn with the radius their shadows are computed with
+        projection = LocalProjection.from_geometries(df.geometry.to_numpy())
+        df["geometry"] = projection.buffer(
+            df.geometry.to_numpy(), get_default_tree_crown_radius()
+        )
         point_json = df.to_json()
         buffered_point_gj = json.loads(point_json)      
 
         return buffered_point_gj
 
-    def create_point_grid(self, geojson_feature):
-        """This function takes a policy polygon feature and generates a point grid"""
-
-        x_spacing = 0.001  # The point spacing you want
-        y_spacing = 0.001
-        df = gpd.GeoDataFrame.from_features([geojson_feature])
-
-        (
-            xmin,
-            ymin,
-            xmax,
-            ymax,
-        ) = df.total_bounds  # Find the bounds of all polygons in the df
-        xcoords = [c for c in np.arange(xmin, xmax, x_spacing)]  # Create x coordinates
-        ycoords = [c for c in np.arange(ymin, ymax, y_spacing)]  # And y
-
-        coordinate_pairs = np.array(np.meshgrid(xcoords, ycoords)).T.reshape(
-            -1, 2
-        )  # Create all combinations of xy coordinates
-        geometries = gpd.points_from_xy(
-            coordinate_pairs[:, 0], coordinate_pairs[:, 1]
-        )  # Create a list of shapely points
-
-        point_df = gpd.GeoDataFrame(
-            geometry=geometries, crs=df.crs
-        )  # Create the point df
-        point_df["geometry"] = point_df["geometry"].buffer(0.00005)
-        point_json = point_df.to_json()
-        point_gj = json.loads(point_json)
-        # TODO Filter the points to keep within bounds of the polygon
-        # filtered_points = df.within(df.at[0,'geometry'])
-        # logger.info(filtered_points)
-        return point_gj
+    def create_point_grid(self, geojson_feature, spacing_meters: float = None) -> np.ndarray:
+        """This function takes a policy polygon feature and returns the points of a regular grid inside the polygon.
+
+        The grid is laid out in the local metric projection of the polygon, the spacing in metres defaults to POLICY_GRID_SPACING_METERS.
+        """
+        spacing_meters = (
+            spacing_meters
+            if spacing_meters
+            else float(os.getenv("POLICY_GRID_SPACING_METERS", 100))
+        )
+        policy_polygon = shape(geojson_feature["geometry"])
+        projection = LocalProjection.from_geometries([policy_polygon])
+        metric_polygon = projection.to_metric([policy_polygon])[0]
+        xmin, ymin, xmax, ymax = metric_polygon.bounds
+
+        grid_x, grid_y = np.meshgrid(
+            np.arange(xmin, xmax, spacing_meters), np.arange(ymin, ymax, spacing_meters)
+        )
+        grid_x = grid_x.ravel()
+        grid_y = grid_y.ravel()
+        # Only the points inside the polygon are kept, concave and diagonal areas cover a fraction of their bounds
+        shapely.prepare(metric_polygon)
+        inside = shapely.contains_xy(metric_polygon, grid_x, grid_y)
+        if not inside.any():
+            # Areas smaller than the spacing still get one point
+            return np.array([policy_polygon.representative_point()], dtype=object)
+        lon, lat = projection.inverse_transform_xy(grid_x[inside], grid_y[inside])
+        return shapely.points(lon, lat)
 
 
 def kickoff_gdh_roads_shadows_stats(roads_shadow_computation_start):
@@ -293,17 +345,17 @@ def kickoff_gdh_roads_shadows_stats(roads_shadow_computation_start):
         + _roads_shadow_computation_details.request_date_time
         + "_gdh_buildings_canopy_shadow"
     )
-    shadows_str = r.get(shadows_key)
-    shadows = json.loads(shadows_str.decode("utf-8"))
+    shadows_data_key = r.get(shadows_key).decode("utf-8")
+    # Road statistics are computed on the full fidelity shadows when they are stored
+    if r.exists(full_fidelity_key(shadows_data_key)):
+        shadows_data_key = full_fidelity_key(shadows_data_key)
     bounds = _roads_shadow_computation_details.bounds
     bounds_hash = hashlib.sha512(bounds.encode("utf-8")).hexdigest()
     roads_storage_key = bounds_hash[:15] + ":roads"
-    roads_str = r.get(roads_storage_key)
-    roads = json.loads(roads_str.decode("utf-8"))
 
     shadow_roads_intersection_data = ShadowsRoadsIntersectionRequest(
-        roads=json.dumps(roads),
-        shadows=shadows,
+        roads_key=roads_storage_key,
+        shadows_key=shadows_data_key,
         job_id=_roads_shadow_computation_details.session_id + ":gdh_roads_shadow",
     )
     compute_road_shadow_overlap(
@@ -324,17 +376,15 @@ def kickoff_existing_buildings_roads_shadows_stats(roads_shadow_computation_star
         + _roads_shadow_computation_details.request_date_time
         + "_existing_buildings_canopy_shadow"
     )
-    shadows_str = r.get(shadows_key)
-    shadows = json.loads(shadows_str.decode("utf-8"))
+    if r.exists(full_fidelity_key(shadows_key)):
+        shadows_key = full_fidelity_key(shadows_key)
     bounds = _roads_shadow_computation_details.bounds
     bounds_hash = hashlib.sha512(bounds.encode("utf-8")).hexdigest()
     roads_storage_key = bounds_hash[:15] + ":roads"
-    roads_str = r.get(roads_storage_key)
-    roads = json.loads(roads_str.decode("utf-8"))
 
     shadow_roads_intersection_data = ShadowsRoadsIntersectionRequest(
-        roads=json.dumps(roads),
-        shadows=json.dumps(shadows),
+        roads_key=roads_storage_key,
+        shadows_key=shadows_key,
         job_id=_roads_shadow_computation_details.session_id
         + ":existing_buildings_roads_shadow",
     )
@@ -365,51 +415,87 @@ def drawn_trees_compute_shadow(tree_processing_payload: dict):
     trees = gpd.GeoDataFrame.from_features(processed_trees_serialzed["features"])
     _shadow_date_time = get_default_shadow_datetime()
     _pd_date_time = pd.to_datetime(_shadow_date_time).tz_localize("UTC")
-    shadows = pybdshadow.bdshadow_sunlight(trees, _pd_date_time)
-    dissolved_shadows = shadows.dissolve()
-    
+    _trees_bounds = ",".join(str(b) for b in trees.total_bounds)
+    sun_position = SolarEphemeris.from_bounds(_trees_bounds).get_position(
+        _pd_date_time
+    )
+    shadows = compute_building_shadows(
+        trees,
+        _pd_date_time,
+        engine=_drawn_trees_shadow_request.shadow_engine,
+        sun_position=sun_position,
+    )
+    dissolved_shadows = dissolve_shadows(shadows)
+    reduced_shadows = reduce_shadow_precision(dissolved_shadows)
+
     redis_key = _drawn_trees_shadow_request.session_id + "_drawn_trees_shadow"
-    r.set(redis_key, json.dumps(dissolved_shadows.to_json()))
-    r.expire(redis_key, time=6000)
-    time.sleep(7)
+    with commit_result(redis_key, ttl=6000) as pipe:
+        pipe.set(redis_key, encode_layer(reduced_shadows), ex=6000)
+        if keep_full_fidelity(_drawn_trees_shadow_request.fidelity):
+            pipe.set(
+                full_fidelity_key(redis_key), encode_layer(dissolved_shadows), ex=6000
+            )
     logger.info("Job Completed...")
 
 
-def compute_existing_buildings_shadow_with_tree_canopy(geojson_session_date_time: dict):
-    _existing_building_date_time = from_dict(
-        data_class=ExistingBuildingsDataShadowGenerationRequest,
-        data=geojson_session_date_time,
-    )
-    _date_time = arrow.get(_existing_building_date_time.request_date_time).isoformat()
-    _pd_date_time = pd.to_datetime(_date_time).tz_convert("UTC")
-    # Combine trees and buildings into one FC
-
-    bounds = _existing_building_date_time.bounds
+def compute_existing_buildings_canopy_shadows(
+    bounds: str, pd_date_time, shadow_engine=None, tile_workers=None
+) -> gpd.GeoDataFrame:
+    """Computes the dissolved shadows of the stored existing buildings and tree canopy for the bounds"""
     bounds_hash = hashlib.sha512(bounds.encode("utf-8")).hexdigest()
     trees_hash_key = bounds_hash[:15] + ":trees"
     existing_buildings_hash_key = bounds_hash[:15] + ":existing_buildings"
 
-    _existing_buildings_raw = r.get(existing_buildings_hash_key)
-    existing_buildings_fc = json.loads(_existing_buildings_raw)
+    existing_buildings = load_layer(r.get(existing_buildings_hash_key))
 
-    existing_buildings = gpd.GeoDataFrame.from_features(
-        existing_buildings_fc["features"]
-    )
+    # Merge the canopy with the shadow
+    canopy_gdf = load_layer(r.get(trees_hash_key))
+
+    sun_position = SolarEphemeris.from_bounds(bounds).get_position(pd_date_time)
+    if tile_workers is None:
+        tile_workers = get_default_tile_workers()
+
+    shadow_engine = resolve_shadow_engine(shadow_engine)
+    shadow_tiler = ShadowTiler(max_workers=tile_workers)
+    # pybdshadow takes the sun position from the buildings of every tile, tiles computed with it would not line up
+    if (
+        tile_workers > 1
+        and shadow_engine != PYBDSHADOW_ENGINE
+        and shadow_tiler.can_tile(existing_buildings, sun_position)
+    ):
+        # City scale layers are split into tiles that are computed and dissolved in parallel
+        dissolved_shadows = shadow_tiler.compute_shadows(
+            existing_buildings, sun_position=sun_position, canopy=canopy_gdf
+        )
+    else:
+        existing_buildings_shadows = compute_building_shadows(
+            existing_buildings,
+            pd_date_time,
+            engine=shadow_engine,
+            sun_position=sun_position,
+        )
 
-    existing_buildings_shadows = pybdshadow.bdshadow_sunlight(
-        existing_buildings, _pd_date_time
-    )
+        ## Merge the downloaded tree canopy with shadows
+        combined_shadows = pd.concat([existing_buildings_shadows, canopy_gdf])
 
-    # Merge the canopy with the shadow
-    downloaded_trees_raw = r.get(trees_hash_key)
-    downloaded_tree_canopy_fc = json.loads(downloaded_trees_raw)
-    _downloaded_tree_canopy_features = downloaded_tree_canopy_fc["features"]
-    canopy_gdf = gpd.GeoDataFrame.from_features(_downloaded_tree_canopy_features)
+        dissolved_shadows = dissolve_shadows(combined_shadows)
+    return dissolved_shadows
 
-    ## Merge the downloaded tree canopy with shadows
-    combined_shadows = pd.concat([existing_buildings_shadows, canopy_gdf])
 
-    dissolved_shadows = combined_shadows.dissolve()
+def compute_existing_buildings_shadow_with_tree_canopy(geojson_session_date_time: dict):
+    _existing_building_date_time = from_dict(
+        data_class=ExistingBuildingsDataShadowGenerationRequest,
+        data=geojson_session_date_time,
+    )
+    _date_time = arrow.get(_existing_building_date_time.request_date_time).isoformat()
+    _pd_date_time = pd.to_datetime(_date_time).tz_convert("UTC")
+
+    dissolved_shadows = compute_existing_buildings_canopy_shadows(
+        _existing_building_date_time.bounds,
+        _pd_date_time,
+        shadow_engine=_existing_building_date_time.shadow_engine,
+        tile_workers=_existing_building_date_time.tile_workers,
+    )
 
     redis_key = (
         _existing_building_date_time.session_id
@@ -417,12 +503,51 @@ def compute_existing_buildings_shadow_with_tree_canopy(geojson_session_date_time
         + _existing_building_date_time.request_date_time
         + "_existing_buildings_canopy_shadow"
     )
-    r.set(redis_key, dissolved_shadows.to_json())
-    r.expire(redis_key, time=6000)
-    time.sleep(7)
+    reduced_shadows = reduce_shadow_precision(dissolved_shadows)
+    with commit_result(redis_key, ttl=6000) as pipe:
+        pipe.set(redis_key, encode_layer(reduced_shadows), ex=6000)
+        if keep_full_fidelity(_existing_building_date_time.fidelity):
+            pipe.set(
+                full_fidelity_key(redis_key), encode_layer(dissolved_shadows), ex=6000
+            )
     logger.info("Existing Buildings + Canopy Shadow Completed")
 
 
+def compute_baseline_shadow(baseline_request: dict) -> str:
+    """Computes the existing buildings and canopy shadow of a project for a reference time, the result is shared by every session"""
+    _baseline_request = from_dict(
+        data_class=BaselineShadowGenerationRequest, data=baseline_request
+    )
+    _date_time = arrow.get(_baseline_request.request_date_time).isoformat()
+    _pd_date_time = pd.to_datetime(_date_time).tz_convert("UTC")
+
+    dissolved_shadows = compute_existing_buildings_canopy_shadows(
+        _baseline_request.bounds,
+        _pd_date_time,
+        shadow_engine=_baseline_request.shadow_engine,
+        tile_workers=_baseline_request.tile_workers,
+    )
+
+    redis_key = baseline_shadow_key(
+        _baseline_request.bounds, _baseline_request.request_date_time
+    )
+    index_key = baseline_index_key(_baseline_request.bounds)
+    with commit_result(redis_key, ttl=BASELINE_SHADOW_TTL) as pipe:
+        pipe.set(
+            redis_key,
+            encode_layer(reduce_shadow_precision(dissolved_shadows)),
+            ex=BASELINE_SHADOW_TTL,
+        )
+        # Views find the baseline closest to their time through the index of the bounds
+        pipe.hset(index_key, _baseline_request.request_date_time, redis_key)
+        pipe.expire(index_key, BASELINE_SHADOW_TTL)
+    logger.info(
+        "Baseline shadow for project %s at %s completed"
+        % (_baseline_request.project_id, _baseline_request.request_date_time)
+    )
+    return redis_key
+
+
 def compute_gdh_shadow_with_tree_canopy(geojson_session_date_time: dict):
 
     _diagramid_building_date_time = from_dict(
@@ -435,7 +560,13 @@ def compute_gdh_shadow_with_tree_canopy(geojson_session_date_time: dict):
     )
 
     _pd_date_time = pd.to_datetime(_date_time).tz_convert("UTC")
-    shadows = pybdshadow.bdshadow_sunlight(gdh_design_diagram_buildings, _pd_date_time)
+    # Only buildings that changed since the last run are projected again
+    shadows = compute_incremental_building_shadows(
+        gdh_design_diagram_buildings,
+        _pd_date_time,
+        bounds=_diagramid_building_date_time.bounds,
+        engine=_diagramid_building_date_time.shadow_engine,
+    )
 
     # # Merge the canopy with the shadow
     # bounds = _diagramid_building_date_time.bounds
@@ -451,7 +582,18 @@ def compute_gdh_shadow_with_tree_canopy(geojson_session_date_time: dict):
     # ## Merge the downloaded tree canopy with shadows
     # combined_shadows = pd.concat([shadows, canopy_gdf])
 
-    dissolved_shadows = shadows.dissolve()
+    dissolved_shadows = dissolve_shadows(shadows)
+
+    # The result is stored under its content key and the session key points to it, like the downloaded layers
+    result_key = _diagramid_building_date_time.result_key
+    if not result_key:
+        result_key = shadow_result_key(
+            buildings=_diagramid_building_date_time.buildings,
+            request_date_time=_diagramid_building_date_time.request_date_time,
+            bounds=_diagramid_building_date_time.bounds,
+            engine=_diagramid_building_date_time.shadow_engine,
+        )
+    reduced_shadows = reduce_shadow_precision(dissolved_shadows)
 
     redis_key = (
         _diagramid_building_date_time.session_id
@@ -459,102 +601,203 @@ def compute_gdh_shadow_with_tree_canopy(geojson_session_date_time: dict):
         + _diagramid_building_date_time.request_date_time
         + "_gdh_buildings_canopy_shadow"
     )
-    r.set(redis_key, json.dumps(dissolved_shadows.to_json()))
-    r.expire(redis_key, time=6000)
-    time.sleep(7)
+    with commit_result(redis_key, ttl=6000) as pipe:
+        pipe.set(result_key, encode_layer(reduced_shadows), ex=SHADOW_RESULT_CACHE_TTL)
+        if keep_full_fidelity(_diagramid_building_date_time.fidelity):
+            pipe.set(
+                full_fidelity_key(result_key),
+                encode_layer(dissolved_shadows),
+                ex=SHADOW_RESULT_CACHE_TTL,
+            )
+        bump_result_version(pipe, result_key, ttl=SHADOW_RESULT_CACHE_TTL)
+        pipe.set(redis_key, result_key, ex=6000)
     logger.info("Job Completed")
 
 
-def compute_polygon_area(polygon: Polygon):
-    geod = Geod(ellps="WGS84")
-    poly_area_m2, poly_perimeter = geod.geometry_area_perimeter(polygon)
-    poly_area_hectares = poly_area_m2 / 10000  # convert from m^2 to hectares
-    return poly_area_hectares
+def get_sweep_date_times(
+    start_date_time: str, end_date_time: str, step_minutes: int
+) -> List[pd.Timestamp]:
+    """Returns the UTC timestamps between start and end (inclusive) at the given step"""
+    _start = pd.to_datetime(arrow.get(start_date_time).isoformat()).tz_convert("UTC")
+    _end = pd.to_datetime(arrow.get(end_date_time).isoformat()).tz_convert("UTC")
+    return list(pd.date_range(_start, _end, freq="{step}min".format(step=step_minutes)))
 
 
-def compute_road_shadow_overlap(
-    roads_shadows_data: ShadowsRoadsIntersectionRequest,
-) -> RoadsShadowOverlap:
-    _roads_shadows_data = from_dict(
-        data_class=ShadowsRoadsIntersectionRequest, data=roads_shadows_data
+def compute_gdh_shadow_sweep(shadow_sweep_request: dict):
+    """This method computes the design shadows for every step between the start and end time, the buildings are parsed once and the results are stored as one time indexed Redis hash"""
+    _shadow_sweep_request = from_dict(
+        data_class=GeodesignhubShadowSweepRequest,
+        data=shadow_sweep_request,
+    )
+    gdh_design_diagram_buildings = gpd.GeoDataFrame.from_features(
+        _shadow_sweep_request.buildings["features"]
+    )
+    sweep_date_times = get_sweep_date_times(
+        start_date_time=_shadow_sweep_request.start_date_time,
+        end_date_time=_shadow_sweep_request.end_date_time,
+        step_minutes=_shadow_sweep_request.step_minutes,
     )
-    roads_str = _roads_shadows_data.roads
-    shadows_str = _roads_shadows_data.shadows
 
-    job_id = _roads_shadows_data.job_id
-    geod = Geod(ellps="WGS84")
-    roads = json.loads(roads_str)
-    shadows = json.loads(shadows_str)
-
-    intersections: List[LineString] = []
-    all_roads: List[LineString] = []
-    all_shadows: List[Polygon] = []
-
-    total_length = 0
-    shadowed_kms = 0
-
-    for line_feature in roads["features"]:
-
-        if line_feature["geometry"]["type"] == "LineString":
-            line = LineString(line_feature["geometry"]["coordinates"])
-        elif line_feature["geometry"]["type"] == "MultiLineString":
-            line = MultiLineString(line_feature["geometry"]["coordinates"])
-        all_roads.append(line)
-        segment_length = geod.geometry_length(line)
-        logger.info(
-            "Segment Length {segment_length:.3f}".format(segment_length=segment_length)
+    # Every step stands for the step length of shade in the shadow hours raster
+    shadow_hours_grid = ShadowHoursGrid(bounds=_shadow_sweep_request.bounds)
+    step_hours = _shadow_sweep_request.step_minutes / 60
+
+    sweep_shadows = {}
+    sun_positions = SolarEphemeris.from_bounds(
+        _shadow_sweep_request.bounds
+    ).get_positions(sweep_date_times)
+    for _pd_date_time, shadows in compute_building_shadows_series(
+        gdh_design_diagram_buildings,
+        sweep_date_times,
+        engine=_shadow_sweep_request.shadow_engine,
+        sun_positions=sun_positions,
+    ):
+        # Every step is stored as disjoint clusters, no overlay is needed to merge them
+        dissolved_shadows = dissolve_shadows(shadows, partitioned=True)
+        sweep_shadows[_pd_date_time.strftime("%Y-%m-%dT%H:%M:%S")] = (
+            encode_layer(reduce_shadow_precision(dissolved_shadows))
+        )
+        shadow_hours_grid.add_shadows(
+            shadows.geometry.to_numpy(), hours=step_hours
         )
-        total_length += segment_length
-    total_shadow_area = 0
-    for shadow_feature in shadows["features"]:
-        s: Polygon = shape(shadow_feature["geometry"])
-
-        poly_area = 0
-        if s.geom_type == "MultiPolygon":
-            # do multipolygon things.
-            all_polygons = list(s.geoms)
-            for p in all_polygons:
-                oriented = orient(p)
-                a = compute_polygon_area(oriented)
-                poly_area += a
-        elif s.geom_type == "Polygon":
-            poly_area = compute_polygon_area(s)
-        else:
-            raise IOError("Shape is not a polygon.")
-        logger.info("Shadow Area {poly_area:.3f}".format(poly_area=poly_area))
-        total_shadow_area += poly_area
 
-        all_shadows.append(s)
+    redis_key = (
+        _shadow_sweep_request.session_id
+        + ":"
+        + _shadow_sweep_request.request_date_time
+        + ":sweep_gdh_shadows"
+    )
+    shadow_hours_key = (
+        _shadow_sweep_request.session_id
+        + ":"
+        + _shadow_sweep_request.request_date_time
+        + ":sweep_gdh_shadow_hours"
+    )
+    with commit_result(redis_key, ttl=6000) as pipe:
+        pipe.delete(redis_key)
+        if sweep_shadows:
+            pipe.hset(redis_key, mapping=sweep_shadows)
+            pipe.expire(redis_key, time=6000)
+        pipe.set(shadow_hours_key, shadow_hours_grid.to_cog(), ex=6000)
+    logger.info(
+        "Shadow sweep with %s steps completed" % str(len(sweep_shadows))
+    )
 
-    roads_tree = STRtree(all_roads)
 
-    for current_s in all_shadows:
-        relevant_roads = [
-            all_roads[idx]
-            for idx in roads_tree.query(current_s, predicate="intersects")
-        ]
+def compute_gdh_roads_shadow_series(shadow_sweep_request: dict):
+    """This method computes the shadowed length of the roads for every step of a sweep from the shadow clusters the sweep job stored, the roads are indexed once for all steps"""
+    _shadow_sweep_request = from_dict(
+        data_class=GeodesignhubShadowSweepRequest,
+        data=shadow_sweep_request,
+    )
+    bounds_hash = hashlib.sha512(
+        _shadow_sweep_request.bounds.encode("utf-8")
+    ).hexdigest()
+    road_index = get_road_index(bounds_hash[:15] + ":roads")
+    sweep_key = (
+        _shadow_sweep_request.session_id
+        + ":"
+        + _shadow_sweep_request.request_date_time
+        + ":sweep_gdh_shadows"
+    )
+    sweep_shadows = {
+        date_time.decode("utf-8"): layer
+        for date_time, layer in r.hgetall(sweep_key).items()
+    }
+
+    date_times = []
+    shadowed_kms = []
+    # Steps are stored as disjoint clusters so overlapping shadows do not count a road twice
+    for _date_time in sorted(sweep_shadows):
+        clusters = load_layer(sweep_shadows[_date_time]).geometry.to_numpy()
+        _, intersection_lengths = road_index.intersect(
+            shapely.get_parts(clusters[~shapely.is_missing(clusters)])
+        )
+        date_times.append(_date_time)
+        shadowed_kms.append(round(float(intersection_lengths.sum()), 2))
 
-        for relevant_road in relevant_roads:
-            # line_buffered = relevant_road.buffer(0.0001)
-            intersection = relevant_road.intersection(current_s)
-            intersection_length = geod.geometry_length(intersection)
+    job_id = (
+        _shadow_sweep_request.session_id
+        + ":"
+        + _shadow_sweep_request.request_date_time
+        + ":roads_shadow_series"
+    )
+    roads_shadow_series = RoadsShadowSeries(
+        job_id=job_id,
+        total_roads_kms=round(float(road_index.total_length), 2),
+        date_times=date_times,
+        shadowed_kms=shadowed_kms,
+    )
+    with commit_result(job_id, ttl=6000) as pipe:
+        pipe.set(
+            job_id,
+            encode_value(json.dumps(asdict(roads_shadow_series)).encode("utf-8")),
+            ex=6000,
+        )
+    logger.info("Roads shadow series with %s steps completed" % str(len(date_times)))
 
-            logger.info(
-                "Intersection Length {intersection_length:.3f}".format(
-                    intersection_length=intersection_length
-                )
-            )
 
-            intersections.append(intersection)
-            shadowed_kms += intersection_length
-    total_shadow_area_rounded = round(total_shadow_area, 2)
+def compute_road_shadow_overlap(
+    roads_shadows_data: ShadowsRoadsIntersectionRequest,
+) -> RoadsShadowOverlap:
+    _roads_shadows_data = from_dict(
+        data_class=ShadowsRoadsIntersectionRequest, data=roads_shadows_data
+    )
+    job_id = _roads_shadows_data.job_id
+    road_index = get_road_index(_roads_shadows_data.roads_key)
+    shadows = load_layer(r.get(_roads_shadows_data.shadows_key))
+    total_length = road_index.total_length
+
+    shadow_geometries = shadows.geometry.to_numpy()
+    shadow_geometries = shadow_geometries[~shapely.is_missing(shadow_geometries)]
+    if not np.isin(
+        shapely.get_type_id(shadow_geometries),
+        [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON],
+    ).all():
+        raise IOError("Shape is not a polygon.")
+    # Dissolved shadows are one large MultiPolygon, its parts are intersected one by one instead of as a whole
+    shadow_parts = shapely.get_parts(shadow_geometries)
+    total_shadow_area = (
+        shapely.area(road_index.projection.to_metric(shadow_parts)).sum() / 10000
+    )  # convert from m^2 to hectares
+
+    road_position, intersection_lengths = road_index.intersect(shadow_parts)
+    shadowed_kms = intersection_lengths.sum()
+    # The shade of every segment comes out of the same intersections
+    shaded_metres, shaded_fraction = road_index.segment_shade(
+        road_position, intersection_lengths
+    )
+    road_shade_key = segment_shade_key(
+        _roads_shadows_data.roads_key, _roads_shadows_data.shadows_key
+    )
+    logger.info(
+        "Intersected {roads} roads with {shadows} shadows in {pairs} pairs".format(
+            roads=len(road_index.geometries),
+            shadows=len(shadow_parts),
+            pairs=len(road_position),
+        )
+    )
+    total_shadow_area_rounded = round(float(total_shadow_area), 2)
     road_shadow_overlap = RoadsShadowOverlap(
-        total_roads_kms=round(total_length, 2),
-        shadowed_kms=round(shadowed_kms, 2),
+        total_roads_kms=round(float(total_length), 2),
+        shadowed_kms=round(float(shadowed_kms), 2),
         job_id=job_id,
         total_shadow_area=total_shadow_area_rounded,
+        segment_shade_key=road_shade_key,
     )
 
-    r.set(job_id, json.dumps(asdict(road_shadow_overlap)))
-    time.sleep(1)
+    with commit_result(job_id, ttl=6000) as pipe:
+        pipe.set(
+            road_shade_key,
+            encode_segment_shade(
+                _roads_shadows_data.roads_key, shaded_metres, shaded_fraction
+            ),
+            ex=6000,
+        )
+        bump_result_version(pipe, road_shade_key, ttl=6000)
+        pipe.set(
+            job_id,
+            encode_value(json.dumps(asdict(road_shadow_overlap)).encode("utf-8")),
+            ex=6000,
+        )
     logger.info("Intersection Completed")
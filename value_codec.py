@@ -0,0 +1,92 @@
+import gzip
+import os
+import zlib
+from typing import Optional
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed values start with a marker and the codec so values stored before compression can still be read
+MAGIC = b"GDHZ"
+GZIP_CODEC = "gzip"
+ZSTD_CODEC = "zstd"
+_codec_ids = {GZIP_CODEC: b"g", ZSTD_CODEC: b"z"}
+_codec_names = {codec_id: name for name, codec_id in _codec_ids.items()}
+HEADER_LENGTH = len(MAGIC) + 1
+
+VALUE_CODEC = os.getenv("VALUE_CODEC", GZIP_CODEC)
+VALUE_COMPRESSION_MIN_BYTES = int(os.getenv("VALUE_COMPRESSION_MIN_BYTES", 16384))
+VALUE_COMPRESSION_LEVEL = int(os.getenv("VALUE_COMPRESSION_LEVEL", 6))
+
+
+def get_value_codec() -> str:
+    if VALUE_CODEC == ZSTD_CODEC and zstandard is None:
+        logger.info("zstandard is not installed, values are compressed with gzip")
+        return GZIP_CODEC
+    return VALUE_CODEC if VALUE_CODEC in _codec_ids else GZIP_CODEC
+
+
+class ValueCompressor:
+    """Compresses a value piece by piece, the output is the header followed by a gzip member or a zstd frame"""
+
+    def __init__(self, codec: Optional[str] = None):
+        self.codec = codec if codec else get_value_codec()
+        if self.codec == ZSTD_CODEC:
+            self.compressor = zstandard.ZstdCompressor(
+                level=VALUE_COMPRESSION_LEVEL
+            ).compressobj()
+        else:
+            # wbits 31 writes a gzip member, its bytes can be sent as a gzip encoded body as they are
+            self.compressor = zlib.compressobj(VALUE_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    def header(self) -> bytes:
+        return MAGIC + _codec_ids[self.codec]
+
+    def compress(self, piece: bytes) -> bytes:
+        return self.compressor.compress(piece)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+
+def encode_value(raw: bytes, codec: Optional[str] = None) -> bytes:
+    """Compresses values of at least VALUE_COMPRESSION_MIN_BYTES, smaller values are stored as they are"""
+    if len(raw) < VALUE_COMPRESSION_MIN_BYTES:
+        return raw
+    compressor = ValueCompressor(codec)
+    return b"".join([compressor.header(), compressor.compress(raw), compressor.flush()])
+
+
+def value_codec(raw: bytes) -> Optional[str]:
+    if raw is None or raw[: len(MAGIC)] != MAGIC:
+        return None
+    return _codec_names.get(bytes(raw[len(MAGIC) : HEADER_LENGTH]))
+
+
+def decode_value(raw: Optional[bytes]) -> Optional[bytes]:
+    """Returns the value as it was before it was compressed, values that are not compressed are returned as they are"""
+    codec = value_codec(raw)
+    if codec is None:
+        return raw
+    payload = raw[HEADER_LENGTH:]
+    if codec == ZSTD_CODEC:
+        if zstandard is None:
+            raise IOError("The value is compressed with zstd and zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(payload)
+    return gzip.decompress(payload)
+
+
+def gzip_payload(raw: Optional[bytes]) -> Optional[bytes]:
+    """Returns the gzip member of a gzip compressed value so it can be sent without decompressing it"""
+    if value_codec(raw) != GZIP_CODEC:
+        return None
+    return raw[HEADER_LENGTH:]
+
+
+def gzip_bytes(raw: bytes) -> bytes:
+    return gzip.compress(raw, compresslevel=VALUE_COMPRESSION_LEVEL)
@@ -0,0 +1,171 @@
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+import geopandas as gpd
+import shapely
+import mapbox_vector_tile
+from pyproj import Transformer
+from typing import Optional, Tuple
+from conn import get_redis
+from geometry_store import load_layer
+from road_shade import load_road_shade_layer
+from job_results import get_result_version
+import logging
+
+logger = logging.getLogger("local-climate-response")
+
+r = get_redis()
+
+TILE_EXTENT = 4096
+# Features are clipped a little outside the tile so that lines and outlines do not show seams at the tile edges
+TILE_BUFFER = 64
+WEB_MERCATOR_ORIGIN = 20037508.342789244
+VECTOR_TILE_CACHE_TTL = int(os.getenv("VECTOR_TILE_CACHE_TTL", 3600))
+MAX_PARSED_LAYERS = int(os.getenv("VECTOR_TILE_MAX_PARSED_LAYERS", 8))
+
+# The layers that can be served as tiles and whether their session key points to a shared storage key
+GDH_SHADOW_LAYER = "gdh_shadow"
+EXISTING_BUILDINGS_SHADOW_LAYER = "existing_buildings_shadow"
+DRAWN_TREES_SHADOW_LAYER = "drawn_trees_shadow"
+ROADS_LAYER = "roads"
+TREES_LAYER = "trees"
+BASELINE_SHADOW_LAYER = "baseline_shadow"
+ROAD_SHADE_LAYER = "road_shade"
+VECTOR_TILE_LAYERS = {
+    GDH_SHADOW_LAYER: True,
+    EXISTING_BUILDINGS_SHADOW_LAYER: False,
+    DRAWN_TREES_SHADOW_LAYER: False,
+    ROADS_LAYER: True,
+    TREES_LAYER: True,
+    BASELINE_SHADOW_LAYER: False,
+    ROAD_SHADE_LAYER: False,
+}
+# Layers that are not stored as a plain layer are joined to their geometries when they are parsed
+LAYER_LOADERS = {ROAD_SHADE_LAYER: load_road_shade_layer}
+
+_to_web_mercator = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+
+
+def get_tile_bounds(z: int, x: int, y: int) -> tuple:
+    """Returns the Web Mercator bounds of a tile in the XYZ scheme"""
+    tile_size = 2 * WEB_MERCATOR_ORIGIN / 2**z
+    xmin = -WEB_MERCATOR_ORIGIN + x * tile_size
+    ymax = WEB_MERCATOR_ORIGIN - y * tile_size
+    return (xmin, ymax - tile_size, xmin + tile_size, ymax)
+
+
+class ParsedLayer:
+    """The features of a stored layer in Web Mercator with a spatial index, parsed once and reused for every tile"""
+
+    def __init__(self, layer: gpd.GeoDataFrame):
+        layer = layer[~(layer.geometry.isna() | layer.geometry.is_empty)]
+        attributes = layer.drop(columns=layer.geometry.name)
+        # Only scalar properties can be encoded in a tile, layers without columns have no records but still one feature per row
+        self.properties = (
+            [
+                {
+                    k: v
+                    for k, v in properties.items()
+                    if isinstance(v, (str, int, float, bool)) and v == v
+                }
+                for properties in attributes.to_dict(orient="records")
+            ]
+            if len(attributes.columns)
+            else [{} for _ in range(len(layer))]
+        )
+        self.geometries = shapely.transform(
+            layer.geometry.to_numpy(),
+            lambda coords: np.column_stack(
+                _to_web_mercator.transform(coords[:, 0], coords[:, 1])
+            ),
+        )
+        self.tree = shapely.STRtree(self.geometries)
+
+    def encode_tile(self, layer: str, z: int, x: int, y: int) -> bytes:
+        xmin, ymin, xmax, ymax = get_tile_bounds(z, x, y)
+        buffer = (xmax - xmin) * TILE_BUFFER / TILE_EXTENT
+        clip_bounds = (xmin - buffer, ymin - buffer, xmax + buffer, ymax + buffer)
+        indices = self.tree.query(shapely.box(*clip_bounds))
+        clipped = shapely.clip_by_rect(self.geometries[indices], *clip_bounds)
+        # Detail finer than a tile pixel is dropped, lower zooms get lighter geometries
+        clipped = shapely.simplify(
+            clipped, (xmax - xmin) / TILE_EXTENT, preserve_topology=True
+        )
+        # Geometries are quantized and oriented here in one pass, the encoder does it feature by feature
+        scale = TILE_EXTENT / (xmax - xmin)
+        quantized = shapely.transform(
+            clipped, lambda coords: (coords - np.array([xmin, ymin])) * scale
+        )
+        quantized = shapely.normalize(shapely.set_precision(quantized, 1.0))
+        features = [
+            {"geometry": geometry, "properties": self.properties[index]}
+            for index, geometry in zip(indices, quantized)
+            if not shapely.is_empty(geometry)
+        ]
+        if not features:
+            return b""
+        return mapbox_vector_tile.encode(
+            [{"name": layer, "features": features}],
+            default_options={
+                "extents": TILE_EXTENT,
+                "check_winding_order": False,
+            },
+        )
+
+
+_parsed_layers: "OrderedDict[str, Tuple[str, ParsedLayer]]" = OrderedDict()
+
+
+def get_layer_version(data_key: str) -> str:
+    """The version marker of the stored layer, values written without one share the version 0"""
+    version = get_result_version(data_key)
+    return str(version) if version is not None else "0"
+
+
+def get_parsed_layer(
+    data_key: str, version: str, loader=load_layer
+) -> Optional[ParsedLayer]:
+    """Returns the parsed layer stored under the key, it is parsed again when the layer was rewritten and the least recently used layers are evicted from the process"""
+    if data_key in _parsed_layers:
+        parsed_version, parsed_layer = _parsed_layers[data_key]
+        if parsed_version == version:
+            _parsed_layers.move_to_end(data_key)
+            return parsed_layer
+    raw = r.get(data_key)
+    if raw is None:
+        return None
+    parsed_layer = ParsedLayer(loader(raw))
+    _parsed_layers[data_key] = (version, parsed_layer)
+    _parsed_layers.move_to_end(data_key)
+    while len(_parsed_layers) > MAX_PARSED_LAYERS:
+        _parsed_layers.popitem(last=False)
+    return parsed_layer
+
+
+def get_vector_tile(layer: str, session_key: str, z: int, x: int, y: int) -> Optional[bytes]:
+    """Returns the encoded tile of a session layer, tiles are cached per stored result and version so sessions sharing a layer share its tiles"""
+    data_key = session_key
+    if VECTOR_TILE_LAYERS[layer]:
+        data_key = r.get(session_key)
+        if data_key is None:
+            return None
+        data_key = data_key.decode("utf-8")
+
+    version = get_layer_version(data_key)
+    result_hash = hashlib.sha1(data_key.encode("utf-8")).hexdigest()
+    tile_key = "vector_tile:{layer}:{result_hash}:{version}:{z}:{x}:{y}".format(
+        layer=layer, result_hash=result_hash, version=version, z=z, x=x, y=y
+    )
+    tile = r.get(tile_key)
+    if tile is not None:
+        return tile
+
+    parsed_layer = get_parsed_layer(
+        data_key, version, LAYER_LOADERS.get(layer, load_layer)
+    )
+    if parsed_layer is None:
+        return None
+    tile = parsed_layer.encode_tile(layer, z, x, y)
+    r.set(tile_key, tile, ex=VECTOR_TILE_CACHE_TTL)
+    return tile